@@ -0,0 +1,230 @@
+"""
+Headless benchmark of Acti :: Label Tool on synthetic ActiGraph exports.
+
+Every synthetic file is first read with each available csv engine, and
+the run stops unless they agree. For every combination of recording
+length and epoch it then reports the load time (parsing, then from the
+cache), the peak memory of a load, the full redraw and pan frame times
+of the plot, and the save time. Figures are drawn with the Agg backend,
+so no display is needed.
+
+    python benchmark.py [--days 1 7 30] [--epochs 1 60] [--json results.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import label_tool
+
+HEADER = """------------ Data File Created By ActiGraph GT3X+ ActiLife v6.13.3 Firmware v2.5.0 date format M/d/yyyy at 30 Hz  Filter Normal -----------
+Serial Number: BENCHMARK
+Start Time 00:00:00
+Start Date 3/1/2021
+Epoch Period (hh:mm:ss) %s
+Download Time 00:00:00
+Download Date 3/1/2021
+Current Memory Address: 0
+Current Battery Voltage: 4.20     Mode = 12
+--------------------------------------------------
+"""
+
+
+def synthetic_csv(file_path, days, epoch, seed=0):
+    """
+    Write an ActiGraph csv export of `days` days at `epoch` seconds: busy
+    days, quiet nights and three hours of non-wear on the second day
+    """
+    rng = np.random.default_rng(seed)
+    seconds = np.arange(int(days * 86400 // epoch)) * epoch
+    hour = (seconds % 86400) / 3600
+    awake = (hour >= 7) & (hour < 23)
+    scale = np.where(awake, 600.0, 15.0) * epoch / 60  # mean counts per epoch
+    counts = rng.gamma(0.6, size=(seconds.size, 3)) * scale[:, None] * [1, 0.8, 0.7]
+    counts[rng.random(seconds.size) < np.where(awake, 0.2, 0.7)] = 0
+    counts[(seconds >= 86400 + 13 * 3600) & (seconds < 86400 + 16 * 3600)] = 0
+    counts = counts.astype(np.int64)
+    # format every distinct date and time of day once
+    dates = pd.date_range('2021-03-01', periods=int(seconds[-1] // 86400) + 1,
+                          freq='D').strftime('%m/%d/%Y')
+    times, inverse = np.unique(seconds % 86400, return_inverse=True)
+    times = (pd.Timestamp(0) + pd.to_timedelta(times, unit='s')).strftime('%H:%M:%S')
+    data = pd.DataFrame({'Date': dates.values[seconds // 86400],
+                         'Time': times.values[inverse],
+                         'Axis1': counts[:, 0], 'Axis2': counts[:, 1],
+                         'Axis3': counts[:, 2],
+                         'Vector Magnitude': np.sqrt((counts.astype(np.float64) ** 2).sum(axis=1)).round(2)})
+    with open(file_path, 'w', newline='') as f:
+        f.write(HEADER % time.strftime('%H:%M:%S', time.gmtime(epoch)))
+        data.to_csv(f, index=False)
+
+
+def check_readers(file_path):
+    """
+    Read a file with every csv engine available and chunk by chunk, and
+    fail unless all of them give the same frame
+    """
+    engines = ['c'] + (['pyarrow'] if label_tool.CSV_ENGINE == 'pyarrow' else [])
+    frames = {engine: label_tool.read_actigraph_csv(file_path, engine=engine)
+              for engine in engines}
+    rows = label_tool.count_rows(file_path, label_tool.sniff_csv(file_path)['skiprows'])
+    frames['chunked'] = pd.concat(label_tool.iter_actigraph_csv(file_path, rows),
+                                  ignore_index=True)
+    expected = frames.pop('c')
+    for name, frame in frames.items():
+        pd.testing.assert_frame_equal(frame, expected, check_dtype=False,
+                                      obj='%s read of %s' % (name, file_path))
+
+
+def timed(function, *args, **kwargs):
+    """ (result, seconds) of a call """
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def peak_memory(function, *args, **kwargs):
+    """ peak bytes allocated during a call """
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def pan_frames(view, labels, width, frames):
+    """ mean seconds of a pan frame with a window of `width` days """
+    x_all = view.pyramid.levels[0][0]
+    x0 = (x_all[0] + x_all[-1] - width) / 2
+    view.ax_vm.set_xlim(x0, x0 + width)
+    view.refresh()
+    start = time.perf_counter()
+    for frame in range(frames):
+        x0 += width / 30
+        view.ax_vm.set_xlim(x0, x0 + width)
+        view.set_labels(*labels.visible(x0, x0 + width))
+        view.refresh()
+    return (time.perf_counter() - start) / frames
+
+
+def bench(file_path, work_dir, frames, memory, out_of_core):
+    """ measurements of one synthetic recording """
+    result = {}
+    cache = label_tool.recording_cache(os.path.join(work_dir, 'cache'))
+    if out_of_core:
+        load = lambda: label_tool.load_recording(file_path, cache, True)
+    else:
+        load = lambda: label_tool.load_recording(file_path)
+    rec, result['load_s'] = timed(load)
+    if not out_of_core:
+        cache.store(file_path, rec)
+    rec, result['load_cached_s'] = timed(label_tool.load_recording, file_path,
+                                         cache, out_of_core)
+    result['rows'] = len(rec)
+    if memory:
+        # out of core, a fresh cache forces the conversion again
+        fresh = label_tool.recording_cache(os.path.join(work_dir, 'cache_memory'))
+        if out_of_core:
+            result['peak_mb'] = peak_memory(label_tool.load_recording, file_path, fresh, True) / 2**20
+        else:
+            result['peak_mb'] = peak_memory(label_tool.load_recording, file_path) / 2**20
+        shutil.rmtree(fresh.cache_dir, ignore_errors=True)
+    # labels from the suggestions, a night of sleep per day
+    spans, result['suggest_ms'] = timed(label_tool.suggest_spans, rec)
+    result['suggest_ms'] *= 1000
+    labels = label_tool.label_store(rec.ts_num)
+    for row, state in zip(*label_tool.suggested_labels(len(rec), *spans)):
+        labels.add(rec.ts_num[row], state)
+    result['labels'] = len(labels)
+    # drawing
+    fig = Figure(figsize=(16, 9), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    view = label_tool.trace_view(fig, canvas)
+    x_all = rec.ts_num
+    view.set_data(rec.pyramid, rec.filename, [x_all[0], x_all[-1]],
+                  rec.pyramid.levels[-1][1].min())
+    view.set_labels(*labels.visible(x_all[0], x_all[-1]))
+    view.set_overview_labels(*labels.compile()[2:])
+    canvas.draw()
+    redraws = []
+    for frame in range(max(frames // 10, 1)):
+        redraws.append(timed(canvas.draw)[1])
+    result['redraw_ms'] = 1000 * sum(redraws) / len(redraws)
+    result['pan_hour_ms'] = 1000 * pan_frames(view, labels, 1 / 24, frames)
+    result['pan_all_ms'] = 1000 * pan_frames(view, labels, x_all[-1] - x_all[0], frames)
+    # save
+    output_path = os.path.join(work_dir, 'labeled.csv')
+    result['save_s'] = timed(label_tool.write_labeled, rec, *labels.spans(),
+                             output_path)[1]
+    os.remove(output_path)
+    shutil.rmtree(cache.cache_dir, ignore_errors=True)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--days', type=float, nargs='+', default=[1, 7, 30],
+        help='recording lengths in days (default: 1 7 30)')
+    parser.add_argument('--epochs', type=int, nargs='+', default=[1, 60],
+        help='epoch lengths in seconds (default: 1 60)')
+    parser.add_argument('--frames', type=int, default=50,
+        help='pan frames timed per window (default: 50)')
+    parser.add_argument('--data', metavar='DIR',
+        help='keep the synthetic files here and reuse them in later runs')
+    parser.add_argument('--no-memory', action='store_true',
+        help='skip the peak memory load, which is slow under tracemalloc')
+    parser.add_argument('--out-of-core', action='store_true',
+        help='load through memory mapped cache files, like files of %d MB and more'
+             % (label_tool.OUT_OF_CORE_BYTES // 2**20))
+    parser.add_argument('--json', metavar='FILE', help='write the results as json')
+    parser.add_argument('--trace', metavar='JSON',
+        help='write the stage timings of the run to a json trace')
+    args = parser.parse_args(argv)
+    data_dir = args.data or tempfile.mkdtemp(prefix='label_tool_bench_')
+    os.makedirs(data_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix='label_tool_work_')
+    columns = [('days', '%6g'), ('epoch', '%6d'), ('rows', '%9d'),
+               ('load_s', '%7.2f'), ('load_cached_s', '%13.3f'),
+               ('peak_mb', '%8.0f'), ('suggest_ms', '%10.1f'),
+               ('redraw_ms', '%9.1f'), ('pan_hour_ms', '%11.1f'),
+               ('pan_all_ms', '%10.1f'), ('save_s', '%7.2f')]
+    print(' '.join('%*s' % (len(fmt % 0), name) for name, fmt in columns), flush=True)
+    results = []
+    try:
+        for days in args.days:
+            for epoch in args.epochs:
+                file_path = os.path.join(data_dir, 'synthetic_%gd_%ds.csv' % (days, epoch))
+                if not os.path.exists(file_path):
+                    synthetic_csv(file_path, days, epoch)
+                check_readers(file_path)
+                result = dict(days=days, epoch=epoch, **bench(
+                    file_path, work_dir, args.frames, not args.no_memory,
+                    args.out_of_core))
+                results.append(result)
+                print(' '.join(fmt % result[name] if name in result
+                               else '%*s' % (len(fmt % 0), '-')
+                               for name, fmt in columns), flush=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        if not args.data:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+    if args.trace:
+        label_tool.timings.dump(args.trace)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
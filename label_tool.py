@@ -6,14 +6,1841 @@ import matplotlib
 from matplotlib.dates import num2date, date2num
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
-from matplotlib.widgets import Cursor
+from matplotlib.collections import PolyCollection
+from matplotlib.ticker import FuncFormatter
 import pandas as pd
 import numpy as np
 import math
 import os
+import bisect
+import threading
+import sys
+import gzip
+import argparse
+import multiprocessing
+import re
+import functools
+import hashlib
+import json
+import shutil
+import tempfile
+import sqlite3
+import collections
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from numpy.lib.format import open_memmap
+from datetime import datetime
+from urllib.request import pathname2url
+
+try:
+    import pyarrow  # optional, multithreaded csv parsing
+    import pyarrow.csv
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
 
 matplotlib.use('TkAgg')
 
+# lower cased csv column names mapped to the names used in here
+COLUMN_ALIASES = {'vector magnitude': 'vm', 'vector.magnitude': 'vm',
+                  'vectormagnitude': 'vm', 'accelerometer x': 'axis1',
+                  'accelerometer y': 'axis2', 'accelerometer z': 'axis3'}
+TIME_COLUMNS = ['date', 'time', 'timestamp', 'ts']
+VALUE_COLUMNS = ['axis1', 'axis2', 'axis3', 'vm']
+CSV_CHUNK_ROWS = 1000000  # rows parsed at a time when strings are involved
+AGD_TICKS_AT_EPOCH = 621355968000000000  # .NET ticks (100 ns) at 1970-01-01
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.acti_label_tool', 'cache')
+CACHE_MAX_BYTES = 2 * 1024**3  # least recently used entries go beyond this
+CACHE_VERSION = 2  # bump when the cached columns change meaning
+PREFETCH_FILES = 2  # files of the folder list loaded ahead in the background
+OUT_OF_CORE_BYTES = 256 * 1024**2  # larger files are memory mapped from the cache
+RECORDING_EXTENSIONS = ('.csv', '.agd')
+LABEL_SIDECAR = '.labels.csv'  # per recording labels, timestamp and state columns
+SUGGEST_SIDECAR = '.suggested.csv'  # per recording suggestions, only shown, never exported
+JOURNAL_SUFFIX = '.labels.journal'  # per recording log of label edits
+JOURNAL_FLUSH_MS = 1000  # edits are written and synced in batches this far apart
+OUTPUT_COLUMNS = ['timestamp', 'axis1', 'axis2', 'axis3', 'vm']
+EXPORT_CHUNK_ROWS = 200000  # rows formatted and written at a time
+EXPORT_FORMATS = {'csv': '.csv', 'csv.gz': '.csv.gz', 'parquet': '.parquet'}
+PROGRESS_MANIFEST = '.label_progress.json'  # done files, kept in the result folder
+PROGRESS_REFRESH_MS = 5000  # how often to look for manifest changes on disk
+SUGGEST_MIN_SLEEP = 60  # minutes, shorter suggested sleep periods are dropped
+SUGGEST_WAKE_GAP = 10  # minutes of wake still counted as part of a sleep period
+SUGGEST_BAND = 0.04  # height of the suggestion band, fraction of the plot
+OVERVIEW_BINS = 2000  # resolution of the whole-recording overview
+COMPARE_ROWS = 12  # tracks shown at once in the compare window
+COMPARE_KEEP = 24  # loaded tracks kept, least recently shown ones go first
+TIMING_KEEP = 10000  # stage timings kept for the trace dump
+TIMING_RECENT = 30  # latest timings per stage averaged by the latency overlay
+
+
+class stage_timer:
+    """
+    Wall clock durations of the stages of loading, drawing and saving.
+    timed(name) wraps a block or, as a decorator, a function. The latest
+    events feed the latency overlay and can be dumped as a json trace.
+    """
+    def __init__(self, keep=TIMING_KEEP):
+        self.events = collections.deque(maxlen=keep)  # (name, start, seconds, thread)
+        self.recent = {}  # name -> deque of the latest durations
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                self.events.append((name, start, seconds, threading.get_ident()))
+                self.recent.setdefault(name, collections.deque(maxlen=TIMING_RECENT)).append(seconds)
+
+    def latest(self, name):
+        """ mean seconds of the latest runs of a stage, None if it never ran """
+        with self.lock:
+            recent = list(self.recent.get(name, ()))
+        return sum(recent) / len(recent) if recent else None
+
+    def summary(self):
+        """ count and mean, median, 95th percentile and max ms per stage """
+        with self.lock:
+            events = list(self.events)
+        table = {}
+        for name in dict.fromkeys(event[0] for event in events):
+            ms = np.array([event[2] for event in events if event[0] == name]) * 1000
+            table[name] = {'count': int(ms.size), 'mean_ms': float(ms.mean()),
+                           'p50_ms': float(np.percentile(ms, 50)),
+                           'p95_ms': float(np.percentile(ms, 95)),
+                           'max_ms': float(ms.max())}
+        return table
+
+    def dump(self, file_path):
+        """ write the events as a chrome://tracing (Perfetto) json trace """
+        with self.lock:
+            events = list(self.events)
+        trace = {'traceEvents': [{'name': name, 'ph': 'X', 'pid': os.getpid(),
+                                  'tid': thread, 'ts': (start - self.origin) * 1e6,
+                                  'dur': seconds * 1e6}
+                                 for name, start, seconds, thread in events],
+                 'displayTimeUnit': 'ms',
+                 'summary': self.summary()}
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(trace, f)
+
+
+timings = stage_timer()  # the stage timings of this process
+
+
+def sniff_csv(file_path):
+    """
+    Inspect the top of a csv export: the ActiGraph header block (start
+    time, epoch length, date format), the number of lines before the data
+    and the normalized column names.
+    """
+    info = {'skiprows': 0, 'start': None, 'epoch': None,
+            'date_format': None, 'names': None, 'raw': False}
+    with open(file_path, encoding='utf-8-sig') as f:
+        head = [f.readline() for _ in range(12)]
+    if head[0].startswith('-') and 'ActiGraph' in head[0]:
+        found = re.search(r'date format (\S+)', head[0])
+        if found:
+            info['date_format'] = actilife_date_format(found.group(1))
+        hz = re.search(r'at (\d+) Hz', head[0])
+        start_date = start_time = None
+        for n, line in enumerate(head[1:], start=1):
+            line = line.strip()
+            if line.startswith('Start Time'):
+                start_time = line.split()[-1]
+            elif line.startswith('Start Date'):
+                start_date = line.split()[-1]
+            elif line.startswith('Epoch Period'):
+                h, m, sec = line.split()[-1].split(':')
+                info['epoch'] = int(h)*3600 + int(m)*60 + int(sec)
+            elif line and set(line) == {'-'}:
+                info['skiprows'] = n + 1
+                break
+        if info['epoch'] == 0 and hz:
+            # raw exports carry a zero epoch and the sampling rate instead
+            info['epoch'] = 1.0 / int(hz.group(1))
+        if start_date and start_time:
+            fmt = (info['date_format'] or '%m/%d/%Y') + ' %H:%M:%S'
+            info['start'] = pd.Timestamp(datetime.strptime(start_date + ' ' + start_time, fmt))
+    first = head[info['skiprows']].strip().split(',')
+    if any(c.isalpha() for c in ''.join(first)):
+        names = [c.strip().strip('"').lower() for c in first]
+        info['raw'] = 'accelerometer x' in names
+        info['names'] = [COLUMN_ALIASES.get(c, c) for c in names]
+        info['skiprows'] += 1
+    else:
+        # no column header, the first three columns are the axes
+        info['names'] = (['axis1', 'axis2', 'axis3'] +
+                         ['column%d' % i for i in range(3, len(first))])
+    if info['date_format'] is None and 'date' in info['names']:
+        # without a header the date order is guessed chunk by chunk; a day
+        # past the 12th at the end of the file settles it for all of them
+        fields = last_line(file_path).split(',')
+        if len(fields) == len(info['names']) and re.match(
+                r'(1[3-9]|2\d|3[01])/\d{1,2}/\d{4}$', fields[info['names'].index('date')].strip()):
+            info['date_format'] = '%d/%m/%Y'
+    return info
+
+
+def actilife_date_format(pattern):
+    """ ActiLife date pattern such as M/d/yyyy to a strftime format """
+    codes = {'yyyy': '%Y', 'yy': '%y', 'MM': '%m', 'M': '%m', 'dd': '%d', 'd': '%d'}
+    return re.sub(r'yyyy|yy|MM|M|dd|d', lambda m: codes[m.group()], pattern)
+
+
+@functools.lru_cache(maxsize=64)
+def timestamp_format(shape):
+    """
+    strftime format matching a timestamp string, keyed by its shape (all
+    digits replaced by 9) so each layout is only guessed once
+    """
+    sample = shape.replace('9', '1')
+    for fmt in ('%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M:%S.%f',
+                '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S.%f',
+                '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S.%f',
+                '%m/%d/%Y %H:%M', '%Y-%m-%d %H:%M'):
+        try:
+            datetime.strptime(sample, fmt)
+            return fmt
+        except ValueError:
+            pass
+    return None
+
+
+def parse_timestamps(chunk, info):
+    """
+    datetime64 values from the date/time or timestamp columns of a chunk
+    of the file sniffed into info. A date layout found to be day first is
+    kept in info['date_format'], so later chunks of the file read the same.
+    """
+    if 'date' in chunk.columns and 'time' in chunk.columns:
+        # few distinct dates and at most a day of distinct times, so parse
+        # the unique values only
+        codes, dates = pd.factorize(chunk['date'])
+        fmt = info['date_format'] or timestamp_format(re.sub(r'\d', '9', dates[0]) + ' 9:99:99')
+        if fmt is not None:
+            fmt = fmt.split(' ')[0]
+        try:
+            dates = pd.to_datetime(dates, format=fmt).values
+        except ValueError:
+            # the guess is month first, the export is day first
+            if fmt is not None and '%m/%d' in fmt:
+                info['date_format'] = fmt.replace('%m/%d', '%d/%m')
+                dates = pd.to_datetime(dates, format=info['date_format']).values
+            else:
+                dates = pd.to_datetime(dates, dayfirst=True).values
+        dates = dates[codes]
+        codes, times = pd.factorize(chunk['time'])
+        timestamp = dates + pd.to_timedelta(times).values[codes]
+        # pandas 3 parses to second or microsecond resolution, the cache
+        # and the rest of the tool expect nanoseconds
+        return timestamp.astype('datetime64[ns]')
+    column = chunk['timestamp'] if 'timestamp' in chunk.columns else chunk['ts']
+    fmt = timestamp_format(re.sub(r'\d', '9', str(column.iloc[0])))
+    try:
+        timestamp = pd.to_datetime(column, format=fmt).values
+    except ValueError:
+        timestamp = pd.to_datetime(column).values
+    return timestamp.astype('datetime64[ns]')
+
+
+def last_line(file_path):
+    """ last non-empty line of a text file, read from its end """
+    with open(file_path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(f.tell() - 4096, 0))
+        lines = f.read().decode('utf-8', 'replace').splitlines()
+    lines = [line for line in lines if line.strip()]
+    return lines[-1] if lines else ''
+
+
+def csv_plan(file_path):
+    """
+    Sniffed layout of a csv export: its info (see sniff_csv), the value
+    and time columns present, their dtypes and the read_csv options
+    """
+    info = sniff_csv(file_path)
+    names = info['names']
+    value_cols = [c for c in VALUE_COLUMNS if c in names]
+    time_cols = [c for c in TIME_COLUMNS if c in names]
+    if 'date' in time_cols:
+        time_cols = ['date', 'time']
+    elif time_cols:
+        time_cols = time_cols[:1]
+    count_type = np.float32 if info['raw'] else np.int32
+    # vm as float64, float32 cannot hold values like 162918.53 exactly and
+    # the output has to give back what was read
+    dtype = {c: np.float64 if c == 'vm' else count_type for c in value_cols}
+    options = dict(sep=',', header=None, skiprows=info['skiprows'], names=names)
+    return info, value_cols, time_cols, dtype, options
+
+
+def complete_columns(df):
+    """ add vm when the file has none and put the columns in output order """
+    if 'vm' not in df.columns:
+        axes = df[['axis1', 'axis2', 'axis3']].values.astype(np.float32)
+        df['vm'] = np.sqrt((axes * axes).sum(axis=1))
+    df['timestamp'] = df['timestamp'].values.astype('datetime64[ns]')
+    return df[OUTPUT_COLUMNS]
+
+
+def read_actigraph_csv(file_path, chunksize=CSV_CHUNK_ROWS, engine=CSV_ENGINE):
+    """
+    Read an ActiGraph (or similar) csv export into a frame with timestamp,
+    axis1-3 and vm columns. Only those columns are parsed, with compact
+    dtypes; epoch-regular ActiGraph exports get their timestamps from the
+    header start time and epoch length instead of parsing them row by row.
+    """
+    info, value_cols, time_cols, dtype, options = csv_plan(file_path)
+    if info['start'] is not None and info['epoch']:
+        # epoch-regular export, no timestamp strings have to be parsed
+        if engine == 'pyarrow':
+            # pandas cannot combine names and usecols with its pyarrow
+            # engine, so pyarrow picks the columns itself
+            table = pyarrow.csv.read_csv(file_path,
+                read_options=pyarrow.csv.ReadOptions(
+                    skip_rows=info['skiprows'], column_names=info['names']),
+                convert_options=pyarrow.csv.ConvertOptions(
+                    include_columns=value_cols,
+                    column_types={c: pyarrow.from_numpy_dtype(np.dtype(t))
+                                  for c, t in dtype.items()}))
+            df = table.to_pandas()
+        else:
+            df = pd.read_csv(file_path, usecols=value_cols, dtype=dtype,
+                             engine='c', **options)
+        step = np.arange(df.shape[0]) * (info['epoch'] * 1e9)
+        timestamp = info['start'].to_datetime64() + step.round().astype('timedelta64[ns]')
+        if time_cols and df.shape[0] and not clock_matches(file_path, info, time_cols, timestamp[-1]):
+            # gaps or clock changes, use the timestamps in the file
+            timestamp = read_timestamps(file_path, info, time_cols, chunksize)
+        df.insert(0, 'timestamp', timestamp)
+    elif time_cols:
+        # parse in chunks so only one chunk of timestamp strings is held
+        # in memory at a time
+        dtype.update({c: str for c in time_cols})
+        chunks = []
+        for chunk in pd.read_csv(file_path, usecols=value_cols + time_cols,
+                                 dtype=dtype, engine='c', chunksize=chunksize,
+                                 **options):
+            timestamp = parse_timestamps(chunk, info)
+            chunk = chunk.drop(columns=time_cols)
+            chunk.insert(0, 'timestamp', timestamp)
+            chunks.append(chunk)
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        raise ValueError('%s has no timestamp column and no ActiGraph header'
+                         % os.path.split(file_path)[1])
+    df = complete_columns(df)
+    df.attrs['filename'] = os.path.split(file_path)[1]
+    df.attrs['epoch'] = info['epoch']
+    return df
+
+
+def count_rows(file_path, skiprows=0, block=1 << 24):
+    """ number of lines of a text file after skiprows, trailing blank lines left out """
+    lines = 0
+    with open(file_path, 'rb') as f:
+        for data in iter(lambda: f.read(block), b''):
+            lines += data.count(b'\n')
+        f.seek(max(f.tell() - 4096, 0))
+        tail = f.read()
+    # the last line with data may or may not end in a newline
+    lines += 1 - tail[len(tail.rstrip()):].count(b'\n')
+    return max(lines - skiprows, 0)
+
+
+def iter_actigraph_csv(file_path, rows, chunksize=CSV_CHUNK_ROWS):
+    """
+    Read a csv export chunk by chunk, each chunk a frame like the one of
+    read_actigraph_csv. rows is the number of data rows (see count_rows),
+    which lets the clock of epoch-regular exports be checked up front.
+    """
+    info, value_cols, time_cols, dtype, options = csv_plan(file_path)
+    regular = info['start'] is not None and info['epoch']
+    if regular and time_cols and rows:
+        last = np.timedelta64(int(round((rows - 1) * info['epoch'] * 1e9)), 'ns')
+        regular = clock_matches(file_path, info, time_cols,
+                                info['start'].to_datetime64() + last)
+    if not regular and not time_cols:
+        raise ValueError('%s has no timestamp column and no ActiGraph header'
+                         % os.path.split(file_path)[1])
+    usecols = value_cols
+    if not regular:
+        # gaps or clock changes, use the timestamps in the file
+        usecols = value_cols + time_cols
+        dtype.update({c: str for c in time_cols})
+    offset = 0
+    for chunk in pd.read_csv(file_path, usecols=usecols, dtype=dtype, engine='c',
+                             chunksize=chunksize, **options):
+        if regular:
+            step = (offset + np.arange(chunk.shape[0])) * (info['epoch'] * 1e9)
+            timestamp = info['start'].to_datetime64() + step.round().astype('timedelta64[ns]')
+        else:
+            timestamp = parse_timestamps(chunk, info)
+            chunk = chunk.drop(columns=time_cols)
+        offset += chunk.shape[0]
+        chunk.insert(0, 'timestamp', timestamp)
+        yield complete_columns(chunk)
+
+
+def clock_matches(file_path, info, time_cols, expected):
+    """ whether the last row of the file carries the expected timestamp """
+    fields = [f.strip().strip('"') for f in last_line(file_path).split(',')]
+    try:
+        tail = pd.DataFrame({c: [fields[info['names'].index(c)]] for c in time_cols})
+        found = parse_timestamps(tail, info)[0]
+    except (IndexError, ValueError):
+        return False
+    return abs(found - expected) <= np.timedelta64(1, 'ms')
+
+
+def read_timestamps(file_path, info, time_cols, chunksize=CSV_CHUNK_ROWS):
+    """ parse only the timestamp columns of a csv export, chunk by chunk """
+    parts = []
+    for chunk in pd.read_csv(file_path, sep=',', header=None,
+                             skiprows=info['skiprows'], names=info['names'],
+                             usecols=time_cols, dtype=str, engine='c',
+                             chunksize=chunksize):
+        parts.append(parse_timestamps(chunk, info))
+    return np.concatenate(parts)
+
+
+class agd_file:
+    """
+    ActiLife AGD file. It is a SQLite database with the epoch counts in
+    its `data` table, keyed by dataTimestamp in .NET ticks, and the device
+    settings in `settings`. The counts are read straight from the table,
+    whole or chunk by chunk along the timestamp key, so no conversion to
+    csv is needed.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.connection = sqlite3.connect(
+            'file:%s?mode=ro' % pathname2url(os.path.abspath(file_path)), uri=True)
+        self.settings = dict(self.connection.execute(
+            'SELECT settingName, settingValue FROM settings').fetchall())
+        self.epoch = int(self.settings.get('epochlength', 60))
+        present = [row[1].lower() for row in
+                   self.connection.execute('PRAGMA table_info(data)')]
+        self.axes = [c for c in ('axis1', 'axis2', 'axis3') if c in present]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def read(self):
+        """ the whole recording as a frame with timestamp, axis1-3 and vm """
+        rows = self.connection.execute(
+            'SELECT dataTimestamp, %s FROM data ORDER BY dataTimestamp'
+            % ', '.join(self.axes)).fetchall()
+        return self.frame(rows)
+
+    def count(self):
+        """ number of epochs in the recording """
+        return self.connection.execute('SELECT COUNT(*) FROM data').fetchone()[0]
+
+    def chunks(self, size=CSV_CHUNK_ROWS):
+        """ the whole recording as frames of up to size rows, in time order """
+        query = ('SELECT dataTimestamp, %s FROM data WHERE dataTimestamp > ? '
+                 'ORDER BY dataTimestamp LIMIT ?' % ', '.join(self.axes))
+        after = -1
+        while True:
+            rows = self.connection.execute(query, (after, size)).fetchall()
+            if not rows:
+                return
+            after = rows[-1][0]
+            yield self.frame(rows)
+
+    def frame(self, rows):
+        """ query result rows as a frame with timestamp, axis1-3 and vm """
+        data = np.array(rows, dtype=np.int64).reshape(-1, len(self.axes) + 1)
+        timestamp = ((data[:, 0] - AGD_TICKS_AT_EPOCH) // 10).astype('datetime64[us]')
+        df = pd.DataFrame({'timestamp': timestamp.astype('datetime64[ns]')})
+        for axis in ('axis1', 'axis2', 'axis3'):
+            if axis in self.axes:
+                df[axis] = data[:, self.axes.index(axis) + 1].astype(np.int32)
+            else:
+                # single axis devices
+                df[axis] = np.zeros(data.shape[0], dtype=np.int32)
+        axes = df[['axis1', 'axis2', 'axis3']].values.astype(np.float32)
+        df['vm'] = np.sqrt((axes * axes).sum(axis=1))
+        df.attrs['filename'] = os.path.split(self.file_path)[1]
+        df.attrs['epoch'] = self.epoch
+        return df
+
+
+def read_agd(file_path):
+    """ Read a whole AGD file, like read_actigraph_csv for csv exports """
+    with agd_file(file_path) as agd:
+        return agd.read()
+
+
+@timings.timed('read')
+def read_recording(file_path):
+    """ Read a recording in any of the supported formats """
+    if file_path.lower().endswith('.agd'):
+        return read_agd(file_path)
+    return read_actigraph_csv(file_path)
+
+
+def stream_recording(file_path, chunksize=CSV_CHUNK_ROWS):
+    """
+    Read a recording in any of the supported formats one chunk at a time.
+    Returns its number of rows, its epoch length and an iterator of frames
+    like the one of read_recording.
+    """
+    if file_path.lower().endswith('.agd'):
+        with agd_file(file_path) as agd:
+            rows, epoch = agd.count(), agd.epoch
+
+        def chunks():
+            with agd_file(file_path) as agd:
+                yield from agd.chunks(chunksize)
+        return rows, epoch, chunks()
+    info = sniff_csv(file_path)
+    rows = count_rows(file_path, info['skiprows'])
+    return rows, info['epoch'], iter_actigraph_csv(file_path, rows, chunksize)
+
+
+class decimation_pyramid:
+    """
+    Min/max envelopes of a signal at successively coarser resolutions.
+    Level 0 is the raw signal, every further level merges `factor` bins of
+    the previous one, so any x window can be drawn from the finest level
+    that still fits the screen. Levels are built `block` bins at a time
+    into arrays from allocate(name, size), memory mapped files included.
+    """
+    def __init__(self, x, y, factor=4, min_size=1000, allocate=None,
+                 block=1 << 22):
+        if allocate is None:
+            x = np.ascontiguousarray(x, dtype=np.float64)
+            y = np.ascontiguousarray(y, dtype=np.float64)
+            allocate = lambda name, size: np.empty(size)
+        block -= block % factor
+        self.levels = [(x, y, y)]
+        while self.levels[-1][0].size > min_size:
+            prev_x, prev_min, prev_max = self.levels[-1]
+            level = len(self.levels)
+            size = -(-prev_x.size // factor)
+            new_x, new_min, new_max = (allocate('level%d_%s' % (level, part), size)
+                                       for part in ('x', 'min', 'max'))
+            for start in range(0, prev_x.size, block):
+                stop = min(start + block, prev_x.size)
+                starts = np.arange(0, stop - start, factor)
+                out = slice(start // factor, start // factor + starts.size)
+                new_x[out] = prev_x[start:stop][starts]
+                new_min[out] = np.minimum.reduceat(prev_min[start:stop], starts)
+                new_max[out] = np.maximum.reduceat(prev_max[start:stop], starts)
+            self.levels.append((new_x, new_min, new_max))
+
+    @classmethod
+    def from_levels(cls, levels):
+        """ rebuild a pyramid from previously computed levels """
+        pyramid = cls.__new__(cls)
+        pyramid.levels = levels
+        return pyramid
+
+    def select(self, x0, x1, max_bins):
+        """
+        Return (level, x, ymin, ymax) of the finest level with at most
+        max_bins bins between x0 and x1, padded by one bin on each side
+        """
+        for level, (x, ymin, ymax) in enumerate(self.levels):
+            i0 = max(np.searchsorted(x, x0, side='right') - 1, 0)
+            i1 = min(np.searchsorted(x, x1, side='left') + 1, x.size)
+            if i1 - i0 <= max_bins:
+                break
+        return level, x[i0:i1], ymin[i0:i1], ymax[i0:i1]
+
+
+class recording:
+    """
+    A loaded file: its columns, time axis and vm decimation pyramid. The
+    columns are arrays keyed by OUTPUT_COLUMNS names, either in memory or
+    memory mapped from the cache; attrs holds filename and epoch.
+    """
+    def __init__(self, columns, attrs, ts_num=None, pyramid=None, file_path=None):
+        self.columns = columns
+        self.attrs = attrs
+        self.file_path = file_path
+        if ts_num is None:
+            ts_num = date2num(columns['timestamp'])  # matplotlib data2num
+        self.ts_num = np.ascontiguousarray(ts_num, dtype=np.float64)
+        if pyramid is None:
+            pyramid = decimation_pyramid(self.ts_num, columns['vm'])
+        self.pyramid = pyramid
+
+    @classmethod
+    @timings.timed('prepare')
+    def from_frame(cls, dataframe, file_path=None):
+        """ a recording of a frame as read by read_recording """
+        return cls({column: dataframe[column].values for column in OUTPUT_COLUMNS},
+                   dict(dataframe.attrs), file_path=file_path)
+
+    def __len__(self):
+        return len(self.ts_num)
+
+    def column(self, name):
+        """ values of a column, KeyError if the file has no such column """
+        return self.columns[name]
+
+    @property
+    def filename(self):
+        return self.attrs['filename']
+
+    @property
+    def raw(self):
+        """ whether the rows are raw acceleration samples rather than epoch counts """
+        epoch = self.attrs.get('epoch')
+        if not epoch and len(self.ts_num) > 1:
+            # no header, go by the spacing of the first samples
+            epoch = float(np.median(np.diff(self.ts_num[:1000]))) * 86400
+        return bool(epoch) and epoch < 1
+
+
+@timings.timed('load')
+def load_recording(file_path, cache=None, out_of_core=None):
+    """
+    Read and prepare a recording, through the cache if one is given. Out
+    of core, the file is converted into the cache once and its columns
+    stay memory mapped from there, so memory use does not grow with the
+    length of the recording. By default files of OUT_OF_CORE_BYTES and
+    more are opened out of core.
+    """
+    if cache is not None:
+        if out_of_core is None:
+            out_of_core = os.path.getsize(file_path) >= OUT_OF_CORE_BYTES
+        rec = cache.load(file_path, 'r' if out_of_core else None)
+        if rec is not None:
+            return rec
+        if out_of_core:
+            cache.convert(file_path)
+            rec = cache.load(file_path, 'r')
+            if rec is not None:
+                return rec
+    rec = recording.from_frame(read_recording(file_path), file_path)
+    if cache is not None:
+        try:
+            cache.store(file_path, rec)
+        except OSError:
+            pass  # a full or read-only disk only costs the next parse
+    return rec
+
+
+def content_digest(file_path, block=1 << 20):
+    """
+    Digest of what a file holds, whatever its path or mtime: its size and
+    its first, middle and last MiB. Sampling keeps hashing a
+    multi-hundred-MB export in the millisecond range while still catching
+    files rewritten in place with the same size.
+    """
+    size = os.path.getsize(file_path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(b'%d|' % size)
+    with open(file_path, 'rb') as f:
+        for offset in sorted({0, max(size // 2 - block // 2, 0),
+                              max(size - block, 0)}):
+            f.seek(offset)
+            digest.update(f.read(block))
+    return digest.hexdigest()
+
+
+def file_fingerprint(file_path, block=1 << 20):
+    """
+    Cache key of a file: its path and modification time and the cache
+    version plus its content digest, so it is only valid on this machine
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(('%d|%s|%d|%s' % (CACHE_VERSION, os.path.abspath(file_path),
+                                    os.stat(file_path).st_mtime_ns,
+                                    content_digest(file_path, block))).encode())
+    return digest.hexdigest()
+
+
+class recording_cache:
+    """
+    On-disk cache of prepared recordings. Each entry is a directory of
+    .npy column files (timestamp, ts_num, axes, vm and the decimation
+    levels) that load without parsing and can be memory mapped. Entries
+    are keyed by file_fingerprint and evicted least recently used first
+    once the cache grows beyond max_bytes.
+    """
+    columns = ['axis1', 'axis2', 'axis3', 'vm']
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @timings.timed('cache load')
+    def load(self, file_path, mmap_mode=None):
+        """ the cached recording of a file, or None """
+        entry = os.path.join(self.cache_dir, file_fingerprint(file_path))
+        try:
+            with open(os.path.join(entry, 'meta.json')) as f:
+                meta = json.load(f)
+            arrays = {name[:-4]: np.load(os.path.join(entry, name), mmap_mode=mmap_mode)
+                      for name in os.listdir(entry) if name.endswith('.npy')}
+        except (OSError, ValueError):
+            return None
+        # loading counts as use for the eviction order
+        os.utime(os.path.join(entry, 'meta.json'))
+        columns = {'timestamp': arrays['timestamp'].view('datetime64[ns]')}
+        for column in self.columns:
+            columns[column] = arrays[column]
+        attrs = {'filename': meta['filename'], 'epoch': meta['epoch']}
+        ts_num = arrays['ts_num']
+        levels = [(ts_num, arrays['vm'], arrays['vm'])]
+        for level in range(1, meta['levels']):
+            levels.append(tuple(arrays['level%d_%s' % (level, part)]
+                                for part in ('x', 'min', 'max')))
+        return recording(columns, attrs, ts_num,
+                         decimation_pyramid.from_levels(levels), file_path)
+
+    def store(self, file_path, rec):
+        """ write a recording into the cache, then evict old entries """
+        key = file_fingerprint(file_path)
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        # unique per call, so concurrent writes of one file never share it
+        tmp = tempfile.mkdtemp(prefix=key + '.tmp', dir=self.cache_dir)
+        try:
+            arrays = {'timestamp': rec.column('timestamp').astype('datetime64[ns]').view(np.int64),
+                      'ts_num': rec.ts_num}
+            for column in self.columns:
+                arrays[column] = rec.column(column)
+            for level, (x, ymin, ymax) in enumerate(rec.pyramid.levels[1:], start=1):
+                arrays['level%d_x' % level] = x
+                arrays['level%d_min' % level] = ymin
+                arrays['level%d_max' % level] = ymax
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(array))
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'filename': rec.filename,
+                           'epoch': rec.attrs.get('epoch'),
+                           'levels': len(rec.pyramid.levels)}, f)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self.evict()
+
+    @timings.timed('convert')
+    def convert(self, file_path, chunksize=CSV_CHUNK_ROWS):
+        """
+        Write the cache entry of a file straight from its chunks, without
+        holding the recording in memory: rows are counted first, then the
+        column files are filled through memory maps and the decimation
+        levels built block by block
+        """
+        key = file_fingerprint(file_path)
+        entry = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry):
+            return
+        # unique per call, so concurrent writes of one file never share it
+        tmp = tempfile.mkdtemp(prefix=key + '.tmp', dir=self.cache_dir)
+        allocate = lambda name, size, dtype=np.float64: open_memmap(
+            os.path.join(tmp, name + '.npy'), 'w+', dtype, (size,))
+        try:
+            rows, epoch, chunks = stream_recording(file_path, chunksize)
+            arrays = {}
+            filled = 0
+            for chunk in chunks:
+                if not arrays:
+                    arrays['timestamp'] = allocate('timestamp', rows, np.int64)
+                    arrays['ts_num'] = allocate('ts_num', rows)
+                    for column in self.columns:
+                        arrays[column] = allocate(column, rows, chunk[column].dtype)
+                part = slice(filled, filled + chunk.shape[0])
+                timestamp = chunk['timestamp'].values.astype('datetime64[ns]')
+                arrays['timestamp'][part] = timestamp.view(np.int64)
+                arrays['ts_num'][part] = date2num(timestamp)
+                for column in self.columns:
+                    arrays[column][part] = chunk[column].values
+                filled = part.stop
+            if not filled:
+                raise ValueError('%s has no data rows' % os.path.split(file_path)[1])
+            if filled < rows:
+                # blank lines were counted as rows
+                for name, array in list(arrays.items()):
+                    os.rename(array.filename, array.filename + '.old')
+                    arrays[name] = allocate(name, filled, array.dtype)
+                    for start in range(0, filled, chunksize):
+                        part = slice(start, min(start + chunksize, filled))
+                        arrays[name][part] = array[part]
+                    del array
+                    os.remove(arrays[name].filename + '.old')
+            pyramid = decimation_pyramid(arrays['ts_num'], arrays['vm'],
+                                         allocate=allocate)
+            for array in arrays.values():
+                array.flush()
+            for level in pyramid.levels[1:]:
+                for array in level:
+                    array.flush()
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump({'filename': os.path.split(file_path)[1],
+                           'epoch': epoch,
+                           'levels': len(pyramid.levels)}, f)
+            del arrays, pyramid
+            os.rename(tmp, entry)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self.evict()
+
+    def evict(self):
+        """ drop least recently used entries until the cache fits max_bytes """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if '.tmp' in name:
+                continue  # being written
+            try:
+                used = os.stat(os.path.join(entry, 'meta.json')).st_mtime
+                size = sum(f.stat().st_size for f in os.scandir(entry))
+            except OSError:
+                continue  # removed by another process meanwhile
+            entries.append((used, size, entry))
+        total = sum(size for _, size, _ in entries)
+        for used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+class progress_index:
+    """
+    Manifest of the labeled files, kept as json in the result folder. It
+    maps each source file name to its output, content digest, label count and
+    save time, is read once into a dict and rewritten on every save. Files
+    saved before the manifest existed count as done when an output with
+    their name is in the folder.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, PROGRESS_MANIFEST)
+        self.entries = {}
+        self.mtime = None
+        self.outputs = set()  # file names in the folder
+        self.refresh()
+
+    def refresh(self):
+        """
+        list the folder again and reload the manifest if it changed on
+        disk, True if either changed
+        """
+        try:
+            outputs = set(os.listdir(self.folder))
+        except OSError:
+            outputs = self.outputs
+        changed = outputs != self.outputs
+        self.outputs = outputs
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return changed
+        if mtime == self.mtime:
+            return changed
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except ValueError:
+            return changed  # caught halfway through a write
+        self.mtime = mtime
+        return True
+
+    def is_done(self, name):
+        if name in self.entries or name in self.outputs:
+            return True
+        stem = os.path.splitext(name)[0]
+        return any(stem + ext in self.outputs for ext in EXPORT_FORMATS.values())
+
+    def record(self, name, output_path, file_hash, n_labels):
+        """ mark a source file as done and write the manifest """
+        self.refresh()  # keep entries written by others meanwhile
+        self.entries[name] = {'output': os.path.split(output_path)[1],
+                              'hash': file_hash, 'labels': n_labels,
+                              'saved': datetime.now().isoformat(timespec='seconds')}
+        self.outputs.add(os.path.split(output_path)[1])
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+
+def compile_labels(ts_num, where, state):
+    """
+    Compile label points into row spans of sleep and discarded data.
+
+    ts_num is the sorted sample time axis, where/state are the label
+    positions and kinds sorted by position, labels at the same position in
+    the order they were placed. A row is asleep if the nearest 's'/'e'
+    label at or before it is an 's', the later one of labels sharing a
+    position; rows before a 'db' label or after a 'da' label are
+    discarded. Returns two int arrays of shape (n, 2) with [start, stop)
+    row ranges.
+    """
+    n = len(ts_num)
+    where = np.asarray(where, dtype=np.float64)
+    state = np.asarray(state, dtype=str)
+    # sleep: each s/e label sets the state of every row from its position on
+    # up to the next s/e label
+    placed = np.flatnonzero(np.isin(state, ['s', 'e']))
+    if placed.size:
+        pos = np.searchsorted(ts_num, where[placed], side='left')
+        # the segment starting at a position is ruled by the last label there
+        last = np.append(pos[1:] != pos[:-1], True)
+        edges = np.append(pos[last], n)
+        asleep = (state[placed[last]] == 's').astype(np.int8)
+        change = np.diff(np.concatenate(([0], asleep, [0])))
+        sleep_spans = np.column_stack((edges[np.flatnonzero(change == 1)],
+                                       edges[np.flatnonzero(change == -1)]))
+        sleep_spans = sleep_spans[sleep_spans[:, 0] < sleep_spans[:, 1]]
+    else:
+        sleep_spans = np.empty((0, 2), dtype=np.int64)
+    # discard: union of everything before a db and after a da label
+    discard_spans = []
+    before = where[state == 'db']
+    if before.size:
+        discard_spans.append((0, np.searchsorted(ts_num, before.max(), side='left')))
+    after = where[state == 'da']
+    if after.size:
+        discard_spans.append((np.searchsorted(ts_num, after.min(), side='right'), n))
+    discard_spans = np.array(discard_spans, dtype=np.int64).reshape(-1, 2)
+    discard_spans = discard_spans[discard_spans[:, 0] < discard_spans[:, 1]]
+    return sleep_spans.astype(np.int64), discard_spans
+
+
+def nearest_index(ts_num, x):
+    """ index of the sample closest to x, clamped to the first/last sample """
+    i = np.searchsorted(ts_num, x, side='left')
+    if i <= 0:
+        return 0
+    if i >= len(ts_num):
+        return len(ts_num) - 1
+    # ties go to the earlier sample
+    if (x - ts_num[i-1]) > (ts_num[i] - x):
+        return i
+    return i - 1
+
+
+def spans_to_mask(spans, start, stop):
+    """ 0/1 mask of rows start to stop covered by [start, stop) row spans """
+    length = stop - start
+    counts = np.zeros(length + 1, dtype=np.int64)
+    np.add.at(counts, np.clip(spans[:, 0] - start, 0, length), 1)
+    np.add.at(counts, np.clip(spans[:, 1] - start, 0, length), -1)
+    return (np.cumsum(counts[:-1]) > 0).astype(np.int8)
+
+
+class label_store:
+    """
+    Labels of one recording, kept sorted by position so inserts and deletes
+    find their place with a binary search. The sleep and discard intervals
+    they describe are compiled once per edit and answer range queries for
+    the visible window. Every edit goes on an undo stack and can be undone
+    and redone, and is logged to the journal when one is attached.
+    """
+    def __init__(self, ts_num):
+        self.ts_num = ts_num
+        self.where = []  # sorted label positions in ts_num units
+        self.state = []  # label kind at the same index: s, e, db or da
+        self.undo_stack = []
+        self.redo_stack = []
+        self.compiled = None  # (sleep, discard) row spans and x ranges
+        self.journal = None  # label_journal receiving every edit
+
+    def __len__(self):
+        return len(self.where)
+
+    def add(self, where, state):
+        self.insert(where, state)
+        self.undo_stack.append(('add', where, state))
+        self.redo_stack = []
+        self.log('add', where, state)
+
+    def add_all(self, labels):
+        """ add (where, state) pairs as one edit, undone and redone at once """
+        edits = tuple(('add', where, state) for where, state in labels)
+        if not edits:
+            return
+        self.log('begin')
+        for edit in edits:
+            self.apply(edit)
+            self.log(*edit)
+        self.log('end')
+        self.undo_stack.append(('group', edits, None))
+        self.redo_stack = []
+
+    def remove(self, where, state):
+        """ remove a label, False if there is no such label """
+        if not self.delete(where, state):
+            return False
+        self.undo_stack.append(('remove', where, state))
+        self.redo_stack = []
+        self.log('remove', where, state)
+        return True
+
+    def has(self, where, state):
+        """ whether the label is placed """
+        i = bisect.bisect_left(self.where, where)
+        j = bisect.bisect_right(self.where, where)
+        return state in self.state[i:j]
+
+    def remove_nearest(self, x):
+        """ remove the label closest to x, returns it or None """
+        if not self.where:
+            return None
+        i = nearest_index(self.where, x)
+        where, state = self.where[i], self.state[i]
+        self.remove(where, state)
+        return where, state
+
+    def undo(self):
+        """ revert the last edit, False if there is none """
+        if not self.undo_stack:
+            return False
+        edit = self.undo_stack.pop()
+        self.apply(edit, reverse=True)
+        self.redo_stack.append(edit)
+        self.log('undo')
+        return True
+
+    def redo(self):
+        """ apply the last undone edit again, False if there is none """
+        if not self.redo_stack:
+            return False
+        edit = self.redo_stack.pop()
+        self.apply(edit)
+        self.undo_stack.append(edit)
+        self.log('redo')
+        return True
+
+    def apply(self, edit, reverse=False):
+        action, where, state = edit
+        if action == 'group':
+            for part in (reversed(where) if reverse else where):
+                self.apply(part, reverse)
+        elif (action == 'add') != reverse:
+            self.insert(where, state)
+        else:
+            self.delete(where, state)
+
+    def log(self, action, where=None, state=None):
+        if self.journal is not None:
+            if where is not None:
+                where = num2date(where).replace(tzinfo=None).isoformat()
+            self.journal.log(action, where, state)
+
+    def snap(self, timestamp):
+        """ label position of the sample nearest to a timestamp string """
+        x = date2num(np.datetime64(timestamp))
+        return self.ts_num[nearest_index(self.ts_num, x)]
+
+    def replay(self, edits, to_where):
+        """
+        Apply journal edits, converting their timestamps with to_where.
+        The undo and redo stacks end up as they were in the session.
+        """
+        group = None  # undo stack size at the begin of a group of edits
+        for action, timestamp, state in edits:
+            if action == 'begin':
+                group = len(self.undo_stack)
+            elif action == 'end' and group is not None:
+                parts = tuple(self.undo_stack[group:])
+                del self.undo_stack[group:]
+                if parts:
+                    self.undo_stack.append(('group', parts, None))
+                group = None
+            elif action == 'add':
+                self.add(to_where(timestamp), state)
+            elif action == 'remove':
+                self.remove(to_where(timestamp), state)
+            elif action == 'undo':
+                self.undo()
+            elif action == 'redo':
+                self.redo()
+
+    def insert(self, where, state):
+        # after equal positions, so the later label rules there
+        i = bisect.bisect_right(self.where, where)
+        self.where.insert(i, where)
+        self.state.insert(i, state)
+        self.compiled = None
+
+    def delete(self, where, state):
+        # the most recent of equal labels goes first
+        i = bisect.bisect_right(self.where, where) - 1
+        while i >= 0 and self.where[i] == where:
+            if self.state[i] == state:
+                del self.where[i]
+                del self.state[i]
+                self.compiled = None
+                return True
+            i -= 1
+        return False
+
+    def spans(self):
+        """ row spans of sleep and discarded data, see compile_labels """
+        return self.compile()[:2]
+
+    def compile(self):
+        if self.compiled is None:
+            sleep_spans, discard_spans = compile_labels(self.ts_num, self.where, self.state)
+            # row spans to x ranges, closing each span on the row that ends it
+            last = len(self.ts_num) - 1
+            sleep_x = self.ts_num[np.minimum(sleep_spans, last)]
+            discard_x = self.ts_num[np.minimum(discard_spans, last)]
+            self.compiled = (sleep_spans, discard_spans, sleep_x, discard_x)
+        return self.compiled
+
+    def visible(self, x0, x1):
+        """ label positions, sleep and discard x ranges between x0 and x1 """
+        sleep_x, discard_x = self.compile()[2:]
+        marks = self.where[bisect.bisect_left(self.where, x0):
+                           bisect.bisect_right(self.where, x1)]
+        # sleep ranges are disjoint, so starts and ends are both sorted
+        i0 = np.searchsorted(sleep_x[:, 1], x0, side='left')
+        i1 = np.searchsorted(sleep_x[:, 0], x1, side='right')
+        discard_x = discard_x[(discard_x[:, 1] >= x0) & (discard_x[:, 0] <= x1)]
+        return marks, sleep_x[i0:i1], discard_x
+
+
+class label_journal:
+    """
+    Append-only log of the label edits of one recording, one line per add,
+    remove, undo or redo, with begin and end around the adds of one edit,
+    kept in a sidecar next to the recording. Logging
+    only appends to a buffer; flush() writes and fsyncs everything logged
+    since the last one and is meant to run off the Tk thread.
+    """
+    def __init__(self, file_path):
+        self.path = file_path
+        self.pending = []
+        self.lock = threading.Lock()
+        self.file = None
+        self.error = None  # last write failure, journaling is off after one
+
+    @staticmethod
+    def read(file_path):
+        """ the edits in a journal as (action, timestamp, state) tuples """
+        edits = []
+        try:
+            with open(file_path, encoding='utf-8') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[0] in ('add', 'remove'):
+                        edits.append(tuple(parts))
+                    elif len(parts) == 1 and parts[0] in ('undo', 'redo', 'begin', 'end'):
+                        edits.append((parts[0], None, None))
+                    # anything else is a line torn by a crash
+        except FileNotFoundError:
+            pass
+        return edits
+
+    def log(self, action, timestamp=None, state=None):
+        line = action if timestamp is None else '%s %s %s' % (action, timestamp, state)
+        with self.lock:
+            self.pending.append(line + '\n')
+
+    def flush(self):
+        with self.lock:
+            lines, self.pending = self.pending, []
+            if not lines or self.error is not None:
+                return
+            try:
+                if self.file is None:
+                    self.file = open(self.path, 'a', encoding='utf-8')
+                    if self.file.tell():
+                        with open(self.path, 'rb') as f:
+                            f.seek(-1, os.SEEK_END)
+                            if f.read(1) != b'\n':
+                                # end a line torn by a crash before appending
+                                lines.insert(0, '\n')
+                self.file.write(''.join(lines))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as error:
+                self.error = error
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def journal_labels(file_path):
+    """ (timestamps, states) of the labels left after replaying a journal """
+    store = label_store(None)
+    store.replay(label_journal.read(file_path), np.datetime64)
+    return [str(where) for where in store.where], list(store.state)
+
+
+def minute_counts(ts_num, values, block=1 << 22):
+    """
+    Counts summed per clock minute, the epoch the sleep and non-wear
+    algorithms are defined for. Returns the counts and the first row of
+    each minute; minutes without samples are left out. Rows are summed a
+    block at a time, so memory mapped recordings are never read whole.
+    """
+    sums, minutes, rows = [], [], []
+    for start in range(0, len(ts_num), block):
+        minute = np.floor((ts_num[start:start + block] - ts_num[0]) * 1440 + 1e-6).astype(np.int64)
+        first = np.flatnonzero(np.diff(minute, prepend=-1))
+        sums.append(np.add.reduceat(np.asarray(values[start:start + block], dtype=np.float64), first))
+        minutes.append(minute[first])
+        rows.append(first + start)
+    sums, minutes, rows = (np.concatenate(parts) for parts in (sums, minutes, rows))
+    # a minute split over two blocks shows up twice
+    keep = np.flatnonzero(np.diff(minutes, prepend=-1))
+    return np.add.reduceat(sums, keep), rows[keep]
+
+
+def weighted_window(x, weights, before):
+    """ sum of weights[k] * x[i - before + k] for every i, zero padded """
+    after = len(weights) - 1 - before
+    return np.correlate(np.pad(x, (before, after)), weights, 'valid')
+
+
+def runs(mask):
+    """ [start, stop) index pairs of the runs of True in a boolean array """
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.column_stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def cole_kripke(counts):
+    """ sleep per minute of axis1 counts, Cole et al. 1992 as scaled in ActiLife """
+    scaled = np.minimum(counts / 100.0, 300)
+    weights = np.array([106, 54, 58, 76, 230, 74, 67]) * 0.001  # minutes -4 to +2
+    return weighted_window(scaled, weights, 4) < 1
+
+
+def sadeh(counts):
+    """ sleep per minute of axis1 counts, Sadeh et al. 1994 """
+    counts = np.minimum(counts, 300)
+    window = np.ones(11)  # minutes -5 to +5
+    avg = weighted_window(counts, window, 5) / 11
+    nats = weighted_window(((counts >= 50) & (counts < 100)).astype(np.float64), window, 5)
+    # sample deviation of the current and 5 preceding minutes
+    s1 = weighted_window(counts, np.ones(6), 5)
+    s2 = weighted_window(counts ** 2, np.ones(6), 5)
+    sd = np.sqrt(np.maximum(s2 - s1 ** 2 / 6, 0) / 5)
+    lg = np.log(counts + 1)
+    return 7.601 - 0.065 * avg - 1.08 * nats - 0.056 * sd - 0.703 * lg > -4
+
+
+def zero_periods(counts, length, spike, context, spike_max=np.inf):
+    """
+    Minute spans of at least length minutes of zero counts. Up to spike
+    minutes of counts no higher than spike_max are tolerated inside them
+    when context minutes on both sides are zero.
+    """
+    n = len(counts)
+    zero = counts == 0
+    moving = runs(~zero)
+    a, b = moving[:, 0], moving[:, 1]
+    peak = np.maximum.reduceat(counts, a) if a.size else np.empty(0)
+    # zero minutes in the windows before and after each movement
+    zeros = np.concatenate(([0], np.cumsum(zero)))
+    quiet_before = zeros[a] - zeros[np.maximum(a - context, 0)] == context
+    quiet_after = zeros[np.minimum(b + context, n)] - zeros[b] == context
+    tolerated = (b - a <= spike) & (peak <= spike_max) & quiet_before & quiet_after
+    still = zero | spans_to_mask(moving[tolerated], 0, n).astype(bool)
+    periods = runs(still)
+    return periods[periods[:, 1] - periods[:, 0] >= length]
+
+
+def choi(counts):
+    """ non-wear minute spans of vm counts, Choi et al. 2011 """
+    return zero_periods(counts, 90, spike=2, context=30)
+
+
+def troiano(counts):
+    """ non-wear minute spans of axis1 counts, Troiano et al. 2008 """
+    return zero_periods(counts, 60, spike=2, context=1, spike_max=100)
+
+
+SLEEP_SCORERS = {'cole-kripke': cole_kripke, 'sadeh': sadeh}
+NONWEAR_SCORERS = {'choi': (choi, 'vm'), 'troiano': (troiano, 'axis1')}
+
+
+@timings.timed('suggest')
+def suggest_spans(rec, sleep='cole-kripke', nonwear='choi'):
+    """
+    Candidate sleep and non-wear periods of a recording as [start, stop)
+    row spans. Minutes scored asleep are joined across short wake gaps and
+    kept when long enough; non-wear minutes are never asleep. The scorers
+    are defined on activity counts, so raw recordings raise ValueError.
+    """
+    if rec.raw:
+        raise ValueError('raw samples, the scorers need epoch counts')
+    ts_num = rec.ts_num
+    n = len(ts_num)
+    axis1, starts = minute_counts(ts_num, rec.column('axis1'))
+    scorer, column = NONWEAR_SCORERS[nonwear]
+    counts = axis1 if column == 'axis1' else minute_counts(ts_num, rec.column(column))[0]
+    off = scorer(counts)
+    asleep = SLEEP_SCORERS[sleep](axis1) & ~spans_to_mask(off, 0, len(axis1)).astype(bool)
+    # fill short wake gaps between sleep, then drop short sleep
+    awake = runs(~asleep)
+    inside = (awake[:, 0] > 0) & (awake[:, 1] < len(asleep))
+    gaps = awake[inside & (awake[:, 1] - awake[:, 0] <= SUGGEST_WAKE_GAP)]
+    bouts = runs(asleep | spans_to_mask(gaps, 0, len(asleep)).astype(bool))
+    bouts = bouts[bouts[:, 1] - bouts[:, 0] >= SUGGEST_MIN_SLEEP]
+    # minute spans to row spans
+    edges = np.append(starts, n)
+    return edges[bouts], edges[off]
+
+
+def suggested_labels(n, sleep_spans, nonwear_spans):
+    """
+    Label rows and kinds for suggested row spans of a recording of n rows:
+    s and e around each sleep period, db and da for non-wear running into
+    the start or the end. Non-wear in between has no label kind and is
+    only shown.
+    """
+    rows, state = [], []
+    for start, stop in sleep_spans:
+        rows += [start, min(stop, n - 1)]
+        state += ['s', 'e']
+    for start, stop in nonwear_spans:
+        if start == 0:
+            rows.append(min(stop, n - 1))
+            state.append('db')
+        elif stop == n:
+            rows.append(start - 1)
+            state.append('da')
+    return rows, state
+
+
+def suggestion_rows(sleep_spans, nonwear_spans):
+    """
+    First and last rows of suggested row spans and their kinds, s/e for
+    sleep and ns/ne for non-wear, as kept in the suggestions sidecar
+    """
+    rows, state = [], []
+    for spans, kinds in ((sleep_spans, ('s', 'e')), (nonwear_spans, ('ns', 'ne'))):
+        for start, stop in spans:
+            rows += [start, stop - 1]
+            state += kinds
+    return rows, state
+
+
+def suggestion_spans(rows, state):
+    """ suggested (sleep, non-wear) row spans back from suggestion_rows """
+    order = np.argsort(rows, kind='stable')
+    rows = np.asarray(rows, dtype=np.int64)[order]
+    state = np.asarray(state, dtype=str)[order]
+    spans = []
+    for start, stop in (('s', 'e'), ('ns', 'ne')):
+        starts, stops = rows[state == start], rows[state == stop] + 1
+        pairs = min(len(starts), len(stops))
+        spans.append(np.column_stack((starts[:pairs], stops[:pairs])))
+    return tuple(spans)
+
+
+def list_recordings(folder):
+    """ sorted names of the recordings in a folder, label files left out """
+    return sorted(name for name in os.listdir(folder)
+                  if name.lower().endswith(RECORDING_EXTENSIONS)
+                  and not name.lower().endswith((LABEL_SIDECAR, SUGGEST_SIDECAR)))
+
+
+def read_label_sidecar(file_path):
+    """ (timestamps, states) of a label file with timestamp and state columns """
+    table = pd.read_csv(file_path, dtype=str)
+    table.columns = table.columns.str.lower()
+    return table['timestamp'].values, table['state'].str.strip().values
+
+
+def write_label_sidecar(file_path, timestamps, states):
+    """ write labels to a sidecar with timestamp and state columns """
+    tmp = file_path + '.tmp'
+    pd.DataFrame({'timestamp': timestamps, 'state': states}).to_csv(tmp, index=False)
+    os.replace(tmp, file_path)
+
+
+def read_label_table(file_path):
+    """
+    labels of many recordings from one csv with file, timestamp and state
+    columns, as {file name: (timestamps, states)}
+    """
+    table = pd.read_csv(file_path, dtype=str)
+    table.columns = table.columns.str.lower()
+    return {name: (group['timestamp'].values, group['state'].str.strip().values)
+            for name, group in table.groupby('file', sort=False)}
+
+
+def snap_labels(ts_num, timestamps):
+    """ label timestamps snapped to the nearest samples, as ts_num values """
+    x = date2num(pd.to_datetime(pd.Series(timestamps)).values)
+    return np.array([ts_num[nearest_index(ts_num, v)] for v in x])
+
+
+def labeled_block(rec, sleep_spans, discard_spans, start, stop):
+    """ rows start to stop of the output: timestamp, axes, vm, sleep, discard """
+    block = pd.DataFrame({column: rec.column(column)[start:stop]
+                          for column in OUTPUT_COLUMNS})
+    block['sleep'] = spans_to_mask(sleep_spans, start, stop)
+    block['discard'] = spans_to_mask(discard_spans, start, stop)
+    return block
+
+
+@timings.timed('save')
+def write_labeled(rec, sleep_spans, discard_spans, output_path,
+                  chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Write a labeled recording block by block as csv, gzip compressed csv
+    (.csv.gz) or parquet (.parquet), picked by the file extension. Only one
+    block of the output exists in memory at a time and the recording is
+    left untouched. The file is written under a temporary name and renamed
+    into place once complete.
+    """
+    n = len(rec.ts_num)
+    folder, name = os.path.split(os.path.abspath(output_path))
+    tmp = os.path.join(folder, '.%s.%d.tmp' % (name, os.getpid()))
+    blocks = (labeled_block(rec, sleep_spans, discard_spans,
+                            start, min(start + chunk_rows, n))
+              for start in range(0, max(n, 1), chunk_rows))
+    try:
+        if output_path.lower().endswith('.parquet'):
+            write_parquet(blocks, tmp)
+        else:
+            opener = gzip.open if output_path.lower().endswith('.gz') else open
+            with opener(tmp, 'wt', encoding='utf-8', newline='') as f:
+                for n_block, block in enumerate(blocks):
+                    # no float_format, values are written as read
+                    block.to_csv(f, index=False, sep=',', header=n_block == 0)
+        os.replace(tmp, output_path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def write_parquet(blocks, file_path):
+    """ write frames as consecutive row groups of one parquet file """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('Writing parquet files needs pyarrow')
+    writer = None
+    try:
+        for block in blocks:
+            table = pa.Table.from_pandas(block, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(file_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+class trace_view:
+    """
+    Persistent artists of the vm plot. The data line and fill are created
+    once and only receive new data; label markers, shading and the
+    crosshair are animated and blitted over a cached background, so label
+    edits and mouse moves never trigger a full redraw. Below the detail
+    axes, an overview of the whole recording is rendered once per file
+    and kept as an image together with the parts of the detail axes that
+    do not follow the x range (title, y axis, spines), so a change of the
+    visible range only redraws the vm line and fill and the x axis.
+    """
+    def __init__(self, fig, canvas):
+        self.fig = fig
+        self.canvas = canvas
+        self.pyramid = None  # decimated vm of the loaded file
+        self.background = None  # cached figure without animated artists
+        self.base = None  # cached figure without the moving artists
+        self.caching = False  # rendering self.base, not a visible draw
+        # data and label subplots, overview below
+        grid = self.fig.add_gridspec(2, 1, height_ratios=[5, 1])
+        self.ax_vm = self.fig.add_subplot(grid[0], label='vm')
+        self.ax_label = self.ax_vm.twinx()
+        self.ax_label.yaxis.set_ticks_position('none')
+        self.ax_label.get_yaxis().set_visible(False)
+        self.ax_overview = self.fig.add_subplot(grid[1], label='overview')
+        self.fig.subplots_adjust(left=0.06, bottom=0.06, right=0.95,
+            top=0.90, wspace=0, hspace=0.5)
+        self.ax_vm.set_title('Please Load Data File')
+        self.ax_vm.set_xlabel('Timestamp')
+        self.ax_vm.set_ylabel('VM Counts')
+        self.thresholds = [
+            self.ax_vm.axhline(y=100, color='r', linestyle='--', alpha=0.5, linewidth=1),  #TODO: modifiable
+            self.ax_vm.axhline(y=500, color='r', linestyle='--', alpha=0.5, linewidth=1)]  #TODO: modifiable
+        self.ax_vm.set_ylim([0, 3000])
+        self.ax_label.set_ylim([0, 3000])
+        self.ax_label.yaxis.set_ticks([])
+        self.ax_vm.yaxis.set_ticks_position('both')
+        self.ax_vm.tick_params(labelright=True)
+        self.ax_vm.grid(True, linewidth=0.2)
+        self.ax_vm.xaxis.set_major_locator(matplotlib.dates.AutoDateLocator())
+        self.ax_vm.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M:%S'))
+        # rotated once here, new ticks take over the style of the first one
+        self.ax_vm.tick_params(axis='x', labelrotation=30)
+        for label in self.ax_vm.get_xticklabels():
+            label.set_horizontalalignment('right')
+        self.ax_overview.set_yticks([])
+        self.ax_overview.tick_params(axis='x', labelsize='small')
+        self.ax_overview.xaxis.set_major_locator(matplotlib.dates.AutoDateLocator())
+        self.ax_overview.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%m-%d'))
+        # data artists
+        self.data_line, = self.ax_vm.plot([], [], alpha=0.5,
+                                          marker='o', markersize=5)
+        self.data_fill = PolyCollection([], alpha=0.3,
+                                        facecolor=self.data_line.get_color(),
+                                        edgecolor='none')
+        self.ax_vm.add_collection(self.data_fill, autolim=False)
+        # label artists, shading spans the full height of the axes
+        self.sleep_shade = PolyCollection([], facecolor='grey', alpha=0.4,
+            edgecolor='none', transform=self.ax_label.get_xaxis_transform(),
+            animated=True)
+        self.discard_shade = PolyCollection([], facecolor='black', alpha=0.8,
+            edgecolor='none', transform=self.ax_label.get_xaxis_transform(),
+            animated=True)
+        self.ax_label.add_collection(self.sleep_shade, autolim=False)
+        self.ax_label.add_collection(self.discard_shade, autolim=False)
+        self.label_marks, = self.ax_label.plot([], [], 'ro', animated=True)
+        # suggested periods, a band along the bottom
+        self.suggest_sleep = PolyCollection([], facecolor='tab:blue', alpha=0.6,
+            edgecolor='none', transform=self.ax_label.get_xaxis_transform(),
+            animated=True)
+        self.suggest_nonwear = PolyCollection([], facecolor='tab:orange', alpha=0.6,
+            edgecolor='none', transform=self.ax_label.get_xaxis_transform(),
+            animated=True)
+        self.ax_label.add_collection(self.suggest_sleep, autolim=False)
+        self.ax_label.add_collection(self.suggest_nonwear, autolim=False)
+        # overview: activity, label shading and the visible range
+        self.overview_fill = PolyCollection([], alpha=0.5,
+                                            facecolor=self.data_line.get_color(),
+                                            edgecolor='none')
+        self.ax_overview.add_collection(self.overview_fill, autolim=False)
+        self.overview_sleep = PolyCollection([], facecolor='grey', alpha=0.4,
+            edgecolor='none', transform=self.ax_overview.get_xaxis_transform(),
+            animated=True)
+        self.overview_discard = PolyCollection([], facecolor='black', alpha=0.8,
+            edgecolor='none', transform=self.ax_overview.get_xaxis_transform(),
+            animated=True)
+        self.viewport = PolyCollection([], facecolor='purple', alpha=0.2,
+            edgecolor='purple', linewidth=1.5,
+            transform=self.ax_overview.get_xaxis_transform(), animated=True)
+        for artist in (self.overview_sleep, self.overview_discard, self.viewport):
+            self.ax_overview.add_collection(artist, autolim=False)
+        # redrawn by refresh, in the stacking order of a full draw; the
+        # thresholds and spines do not move but lie over the fill
+        self.moving = sorted([self.data_fill, self.ax_vm.xaxis] + self.thresholds +
+                             [self.data_line] + list(self.ax_vm.spines.values()),
+                             key=lambda artist: artist.get_zorder())
+        # latency overlay, off by default
+        self.latency = self.fig.text(0.01, 0.97, '', fontsize='small',
+            family='monospace', verticalalignment='top', visible=False,
+            animated=True)
+        # crosshair
+        self.cursor_h = self.ax_label.axhline(0, color='green', linewidth=0.3,
+                                              visible=False, animated=True)
+        self.cursor_v = self.ax_label.axvline(0, color='green', linewidth=0.3,
+                                              visible=False, animated=True)
+        self.overlay = [self.sleep_shade, self.discard_shade,
+                        self.suggest_sleep, self.suggest_nonwear,
+                        self.label_marks, self.cursor_h, self.cursor_v,
+                        self.overview_sleep, self.overview_discard, self.viewport,
+                        self.latency]
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.canvas.mpl_connect('resize_event', self.on_resize)
+
+    def set_data(self, pyramid, title, xlim, ymin):
+        """ show a newly loaded file """
+        self.pyramid = pyramid
+        self.ax_vm.set_title(title)
+        self.ax_vm.set_xlabel('Timestamp')
+        self.ax_vm.set_ylabel('Counts')
+        self.ax_vm.set_ylim(ymin, 3000)
+        self.ax_label.set_ylim(ymin, 3000)
+        self.ax_vm.set_xlim(xlim)
+        self.update_data()
+        self.set_overview()
+
+    def set_overview(self):
+        """ draw the whole recording into the overview, once per file """
+        x_all = self.pyramid.levels[0][0]
+        x, ymin, ymax = self.pyramid.select(x_all[0], x_all[-1], OVERVIEW_BINS)[1:]
+        self.overview_fill.set_verts(self.fill_verts(x, ymax))
+        self.ax_overview.set_xlim(x_all[0], x_all[-1])
+        self.ax_overview.set_ylim(0, max(ymax.max(), 1))
+        self.base = None
+        self.update_viewport()
+
+    def set_overview_labels(self, sleep_spans, discard_spans):
+        """ label shading of the overview, as lists of (x start, x end) pairs """
+        self.overview_sleep.set_verts([self.span_verts(*span) for span in sleep_spans])
+        self.overview_discard.set_verts([self.span_verts(*span) for span in discard_spans])
+
+    def update_viewport(self):
+        """ mark the range of the detail axes in the overview """
+        self.viewport.set_verts([self.span_verts(*self.ax_vm.get_xlim())])
+
+    def update_data(self):
+        """
+        Feed the vm line and fill with the decimation level matching the
+        visible x range, so a redraw never pushes more than about two
+        vertices per horizontal pixel to the renderer
+        """
+        if self.pyramid is None:
+            return
+        x0, x1 = self.ax_vm.get_xlim()
+        max_bins = max(int(self.ax_vm.bbox.width), 100)
+        level, x, ymin, ymax = self.pyramid.select(x0, x1, max_bins)
+        if level == 0:
+            # raw samples, keep markers so single points can be picked
+            self.data_line.set_data(x, ymax)
+            self.data_line.set_marker('o')
+        else:
+            # interleave min and max of each bin to draw the envelope
+            self.data_line.set_data(np.repeat(x, 2),
+                                    np.column_stack((ymin, ymax)).ravel())
+            self.data_line.set_marker('None')
+        self.data_fill.set_verts(self.fill_verts(x, ymax))
+
+    def set_labels(self, marks, sleep_spans, discard_spans):
+        """
+        Update label markers (x positions) and shading, given as lists of
+        (x start, x end) pairs
+        """
+        self.label_marks.set_data(marks, np.zeros(len(marks)))
+        self.sleep_shade.set_verts([self.span_verts(*span) for span in sleep_spans])
+        self.discard_shade.set_verts([self.span_verts(*span) for span in discard_spans])
+
+    def set_suggestions(self, sleep_spans, nonwear_spans):
+        """ show suggested periods, given as (x start, x end) pairs """
+        self.suggest_sleep.set_verts([self.span_verts(*span, top=SUGGEST_BAND)
+                                      for span in sleep_spans])
+        self.suggest_nonwear.set_verts([self.span_verts(*span, top=SUGGEST_BAND)
+                                        for span in nonwear_spans])
+
+    @staticmethod
+    def span_verts(start, end, top=1):
+        """ rectangle up to top in x data / y axes coordinates """
+        return [(start, 0), (start, top), (end, top), (end, 0)]
+
+    @staticmethod
+    def fill_verts(x, y):
+        """ polygons of the area between y and zero, for set_verts """
+        if not x.size:
+            return []
+        verts = np.empty((x.size + 2, 2))
+        verts[1:-1, 0] = x
+        verts[1:-1, 1] = y
+        verts[0] = (x[0], 0)
+        verts[-1] = (x[-1], 0)
+        return [verts]
+
+    def move_cursor(self, event, blit=True):
+        """ follow the mouse with the crosshair """
+        inside = event.inaxes in (self.ax_vm, self.ax_label)
+        if inside:
+            x, y = self.ax_label.transData.inverted().transform((event.x, event.y))
+            self.cursor_v.set_xdata([x, x])
+            self.cursor_h.set_ydata([y, y])
+        elif not self.cursor_v.get_visible():
+            return
+        self.cursor_v.set_visible(inside)
+        self.cursor_h.set_visible(inside)
+        if blit:
+            self.blit()
+
+    def on_resize(self, event):
+        """ the number of bins to draw follows the axes width """
+        self.base = None
+        self.update_data()
+
+    def on_draw(self, event):
+        """ cache the freshly drawn background and put the overlay on it """
+        if self.caching:
+            return
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_overlay()
+
+    def cache_base(self):
+        """ render the figure without the moving artists, the base of refresh """
+        for artist in self.moving:
+            artist.set_visible(False)
+        self.caching = True
+        try:
+            renderer = self.canvas.get_renderer()
+            renderer.clear()
+            self.fig.draw(renderer)
+            self.base = self.canvas.copy_from_bbox(self.fig.bbox)
+        finally:
+            self.caching = False
+            for artist in self.moving:
+                artist.set_visible(True)
+
+    def show_latency(self, show):
+        """ turn the frame time overlay on or off """
+        self.latency.set_visible(show)
+        self.blit()
+
+    def latency_text(self):
+        """ mean times of the latest frames, redraws and blits """
+        parts = []
+        frame = timings.latest('pan frame')
+        if frame:
+            parts.append('pan %.1f ms (%.0f fps)' % (frame * 1000, 1 / frame))
+        for name in ('blit', 'full redraw'):
+            seconds = timings.latest(name)
+            if seconds is not None:
+                parts.append('%s %.1f ms' % (name, seconds * 1000))
+        return '   '.join(parts)
+
+    def draw_overlay(self):
+        """ draw the animated artists onto the canvas renderer """
+        if self.latency.get_visible():
+            self.latency.set_text(self.latency_text())
+        for artist in self.overlay:
+            self.ax_label.draw_artist(artist)
+
+    @timings.timed('blit')
+    def blit(self):
+        """ redraw only the animated artists over the cached background """
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_overlay()
+        self.canvas.blit(self.fig.bbox)
+
+    @timings.timed('pan frame')
+    def refresh(self):
+        """
+        Redraw after the visible x range changed: the vm line and fill and
+        the x axis with its ticks and grid are drawn over the cached rest of
+        the figure. Laying out the y axis and the title was most of the
+        time of a frame.
+        """
+        self.update_data()
+        self.update_viewport()
+        if self.base is None:
+            self.cache_base()
+        self.canvas.restore_region(self.base)
+        for artist in self.moving:
+            self.ax_vm.draw_artist(artist)
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_overlay()
+        self.canvas.blit(self.fig.bbox)
+
+
+class compare_view:
+    """
+    Stacked vm tracks of several recordings on a shared x axis. The axes
+    and their artists are created once per row and show whichever track
+    is scrolled into that row, drawn from its decimation pyramid at the
+    resolution of the screen. Tracks are shifted by their offset (days).
+    """
+    def __init__(self, fig, canvas, rows=COMPARE_ROWS):
+        self.fig = fig
+        self.canvas = canvas
+        self.tracks = [None] * rows  # compare_track shown in each row
+        self.axes, self.lines, self.fills = [], [], []
+        self.sleep, self.discard, self.titles = [], [], []
+        self.fig.subplots_adjust(left=0.02, bottom=0.06, right=0.99,
+            top=0.98, hspace=0.1)
+        for row in range(rows):
+            ax = self.fig.add_subplot(rows, 1, row + 1,
+                                      sharex=self.axes[0] if self.axes else None)
+            ax.set_yticks([])
+            ax.tick_params(axis='x', labelbottom=row == rows - 1, labelsize='small')
+            line, = ax.plot([], [], alpha=0.5, linewidth=0.8)
+            fill = PolyCollection([], alpha=0.3, facecolor=line.get_color(),
+                                  edgecolor='none')
+            sleep = PolyCollection([], facecolor='grey', alpha=0.4,
+                edgecolor='none', transform=ax.get_xaxis_transform())
+            discard = PolyCollection([], facecolor='black', alpha=0.8,
+                edgecolor='none', transform=ax.get_xaxis_transform())
+            for collection in (fill, sleep, discard):
+                ax.add_collection(collection, autolim=False)
+            title = ax.text(0.003, 0.92, '', transform=ax.transAxes,
+                            verticalalignment='top', fontsize='small')
+            self.axes.append(ax)
+            self.lines.append(line)
+            self.fills.append(fill)
+            self.sleep.append(sleep)
+            self.discard.append(discard)
+            self.titles.append(title)
+        self.axes[0].xaxis.set_major_locator(matplotlib.dates.AutoDateLocator())
+        self.canvas.mpl_connect('resize_event', self.on_resize)
+
+    def show(self, row, track):
+        """ put a track, or nothing, into a row """
+        self.tracks[row] = track
+        rec = None if track is None else track.rec
+        if track is None:
+            self.titles[row].set_text('')
+        elif track.error is not None:
+            self.titles[row].set_text('%s  (%s)' % (track.name, track.error))
+        else:
+            self.titles[row].set_text(track.name if rec is not None else
+                                      track.name + '  (loading)')
+        if rec is None:
+            self.lines[row].set_data([], [])
+            for collection in (self.fills[row], self.sleep[row], self.discard[row]):
+                collection.set_verts([])
+            return
+        # the same scale for every track, robust to a few spikes
+        top = np.percentile(rec.pyramid.levels[-1][2], 99) * 1.2
+        self.axes[row].set_ylim(0, max(top, 1))
+        self.sleep[row].set_verts([trace_view.span_verts(start - track.offset, end - track.offset)
+                                   for start, end in track.sleep_x])
+        self.discard[row].set_verts([trace_view.span_verts(start - track.offset, end - track.offset)
+                                     for start, end in track.discard_x])
+        self.update_row(row)
+
+    def update_data(self):
+        """ feed every row with the data of the visible x range """
+        for row in range(len(self.axes)):
+            self.update_row(row)
+
+    def update_row(self, row):
+        track = self.tracks[row]
+        if track is None or track.rec is None:
+            return
+        ax = self.axes[row]
+        x0, x1 = ax.get_xlim()
+        max_bins = max(int(ax.bbox.width), 100)
+        level, x, ymin, ymax = track.rec.pyramid.select(x0 + track.offset,
+                                                        x1 + track.offset, max_bins)
+        x = x - track.offset
+        if level == 0:
+            self.lines[row].set_data(x, ymax)
+        else:
+            self.lines[row].set_data(np.repeat(x, 2),
+                                     np.column_stack((ymin, ymax)).ravel())
+        self.fills[row].set_verts(trace_view.fill_verts(x, ymax))
+
+    def on_resize(self, event):
+        """ the number of bins to draw follows the axes width """
+        self.update_data()
+
+
 class label_tool:
     def __init__(self, parent):
         self.parent = parent
@@ -22,16 +1849,46 @@ class label_tool:
         self.parent.grid_rowconfigure(1, weight=1)
         self.parent.grid_columnconfigure(0, weight=1)
         # Variables
-        self.dataframe = None  # to store read data frame
+        self.recording = None  # loaded file, see load_recording
+        self.cache = None  # prepared recordings on disk
+        self.ts_num = None  # contiguous copy of the time axis for lookups
+        self.pyramid = None  # min/max decimation of vm for rendering
         self.mouse_event = None  # mouse event
-        self.labels = None  # to store user labels for marking sleep
+        self.labels = None  # label_store of the current file
+        self.journal = None  # label_journal of the current file
+        self.journal_writer = ThreadPoolExecutor(max_workers=1)
+        self.journal_flush = None  # after() id of the next journal flush
+        self.suggestions = None  # suggested (sleep, non-wear) row spans
+        self.sleep_scorer = StringVar(value='cole-kripke')
+        self.nonwear_scorer = StringVar(value='choi')
+        self.show_latency = BooleanVar(value=False)
+        self.compare = None  # compare_window, while open
         self.current_xlim = None  # store current x axis limits info
         self.button_1_pressed = False  # mouse left button press indicator
         self.pan_init_xlim = None  # panning event x axis limits info
+        self.overview_drag = False  # left button held down in the overview
+        self.refresh_pending = None  # after_idle() id of a coalesced redraw
         self.folder_dir = None  # data source directory
         self.folder_items = None  # indicates the file being worked on
         self.folder_labeled_dir = None  # results directory
+        self.done_files = set()  # names in the folder list already labeled
+        self.progress_index = None  # manifest of the result folder
+        self.progress_poll = None  # after() id of the manifest refresh
+        self.progress_refresh = None  # future of a progress_index.refresh
+        # lists the result folder, which can be large or on the network
+        self.folder_reader = ThreadPoolExecutor(max_workers=1)
+        self.loader = ThreadPoolExecutor(max_workers=PREFETCH_FILES)  # prefetches
+        # files asked for, never queued behind prefetches or each other
+        self.opener = ThreadPoolExecutor()
+        self.pending_load = None  # future of the file about to be shown
+        self.load_poll = None  # after() id while waiting for pending_load
+        self.prefetched = {}  # file path -> future of upcoming folder files
+        self.prefetch_poll = None  # after() id while prefetches are running
         self.zoom_speed = 0.3  # zoom speed
+        try:
+            self.cache = recording_cache()
+        except OSError:
+            pass  # no writable home directory, files get parsed every time
         # UI Elements
         # menu
         self.menu_bar = Menu(self.parent)
@@ -43,24 +1900,55 @@ class label_tool:
             command=self.btn_load_folder)
         self.file_menu.add_command(label='Save',
             command=self.btn_save, state='disabled')
+        self.file_menu.add_command(label='Compare Files',
+            command=self.btn_compare)
         self.file_menu.add_separator()
         self.file_menu.add_command(label='Set Result Folder',
             command=self.btn_labeled_folder)
         self.file_menu.add_separator()
         self.file_menu.add_command(label='Exit', comman=self.btn_exit)
         self.menu_bar.add_cascade(label='File', menu=self.file_menu)
+        self.label_menu = Menu(self.menu_bar)
+        self.label_menu.add_command(label='Accept All Suggestions',
+            command=self.accept_suggestions)
+        self.label_menu.add_separator()
+        self.label_menu.add_radiobutton(label='Sleep: Cole-Kripke',
+            variable=self.sleep_scorer, value='cole-kripke', command=self.suggest)
+        self.label_menu.add_radiobutton(label='Sleep: Sadeh',
+            variable=self.sleep_scorer, value='sadeh', command=self.suggest)
+        self.label_menu.add_separator()
+        self.label_menu.add_radiobutton(label='Non-wear: Choi',
+            variable=self.nonwear_scorer, value='choi', command=self.suggest)
+        self.label_menu.add_radiobutton(label='Non-wear: Troiano',
+            variable=self.nonwear_scorer, value='troiano', command=self.suggest)
+        self.menu_bar.add_cascade(label='Labels', menu=self.label_menu)
         self.help_menu = Menu(self.menu_bar)
         self.help_menu.add_command(label='About', command=self.btn_about)
+        self.help_menu.add_separator()
+        self.help_menu.add_checkbutton(label='Show Latency',
+            variable=self.show_latency, command=self.btn_latency)
+        self.help_menu.add_command(label='Save Timing Trace',
+            command=self.btn_trace)
         self.menu_bar.add_cascade(label='Help', menu=self.help_menu)
         # structure
         self.upper_frame = ttk.Frame(self.parent)
         self.upper_frame.grid(column=0, row=0, sticky=(N,E,S))
         self.lower_frame = ttk.Frame(self.parent)
         self.lower_frame.grid(column=0, row=1, sticky=(N,W,E,S))
-        # undo button
-        self.btn_undo = Button(self.upper_frame, text="Undo",
-                                command = self.btn_undo)
-        self.btn_undo.grid(column=1, row=0, sticky=(E))
+        # load status and progress
+        self.status = StringVar()
+        self.status_label = ttk.Label(self.upper_frame, textvariable=self.status)
+        self.status_label.grid(column=0, row=0, sticky=(E), padx=5)
+        self.progress = ttk.Progressbar(self.upper_frame, mode='indeterminate',
+                                        length=100)
+        self.progress.grid(column=1, row=0, sticky=(E), padx=5)
+        # undo and redo buttons
+        self.undo_button = Button(self.upper_frame, text="Undo",
+                                  command = self.btn_undo)
+        self.undo_button.grid(column=2, row=0, sticky=(E))
+        self.redo_button = Button(self.upper_frame, text="Redo",
+                                  command = self.btn_redo)
+        self.redo_button.grid(column=3, row=0, sticky=(E))
         # file list
         self.file_list = Listbox(self.parent, selectmode=SINGLE,
             selectbackground="purple")
@@ -71,26 +1959,10 @@ class label_tool:
         self.plot_canvas = FigureCanvasTkAgg(self.fig, master=self.lower_frame)
         self.plot_canvas._tkcanvas.pack(fill=BOTH, expand=True)
         # data and label subplots
-        self.fig_plot_vm = self.fig.add_subplot(111, label='vm')
-        self.fig_plot_label = self.fig_plot_vm.twinx()
-        self.fig_plot_label.yaxis.set_ticks_position('none')
-        self.fig_plot_label.get_yaxis().set_visible(False)
-        self.fig.subplots_adjust(left=0.06, bottom=0.1, right=0.95,
-            top=0.90, wspace=0, hspace=0)
-        self.fig_plot_vm.set_title('Please Load Data File')
-        self.fig_plot_vm.set_xlabel('Timestamp')
-        self.fig_plot_vm.set_ylabel('VM Counts')
-        self.fig_plot_vm.axhline(y=100, color='r', linestyle='--', alpha=0.5, linewidth=1)
-        self.fig_plot_vm.axhline(y=500, color='r', linestyle='--', alpha=0.5, linewidth=1)
-        self.fig_plot_vm.set_ylim([0, 3000])
-        self.fig_plot_vm.yaxis.set_ticks_position('both')
-        self.fig_plot_vm.tick_params(labelright=True)
-        self.fig_plot_vm.grid(True, linewidth=0.2)
-        self.cursor = Cursor(self.fig_plot_label,
-                        horizOn = True,
-                        vertOn = True,
-                        color = 'green',
-                        linewidth=0.3)
+        self.view = trace_view(self.fig, self.plot_canvas)
+        self.fig_plot_vm = self.view.ax_vm
+        self.fig_plot_label = self.view.ax_label
+        self.fig_plot_overview = self.view.ax_overview
         # callbacks of plots
         self.plot_canvas.callbacks.connect('scroll_event', self.scroll_func)
         self.plot_canvas.callbacks.connect('key_press_event',
@@ -105,45 +1977,66 @@ class label_tool:
 
     def btn_load(self):
         """ load file prompt """
-        full_path = filedialog.askopenfilename(filetypes=[('CSV files', '*.csv',)])
+        full_path = filedialog.askopenfilename(filetypes=[
+            ('ActiGraph files', '*.csv *.agd'), ('CSV files', '*.csv',),
+            ('AGD files', '*.agd',)])
         if full_path:
-            self.reset()
-            self.read_file(file_path=full_path)
-            self.format_data()
-            self.plot()
+            self.open_file(full_path)
 
     def btn_load_folder(self):
         """ load folder prompt """
         self.folder_dir = filedialog.askdirectory()
         if self.folder_dir:
-            list_of_files = sorted(os.listdir(self.folder_dir))
+            self.file_list.delete(0, END)
+            self.done_files = set()
+            list_of_files = list_recordings(self.folder_dir)
             for csv_files in list_of_files:
                 self.file_list.insert(END, csv_files)
             # If result folder is already loaded, check which files are done
             if self.folder_labeled_dir:
                 self.which_are_done()
+            self.prefetch_next()
 
     def btn_labeled_folder(self):
         """ set the result folder """
         self.folder_labeled_dir = filedialog.askdirectory()
         # if a data folder is loaded, check which files are done
-        if self.folder_dir:
+        if self.folder_dir and self.folder_labeled_dir:
             self.which_are_done()
 
     def btn_save(self):
         """ save file prompt """
-        if self.dataframe is not None:
-            f = filedialog.asksaveasfile(defaultextension=".csv",
-                initialfile=os.path.split(self.dataframe.filename)[1])
-            if f is not None:
-                self.tidy()
-                self.dataframe.to_csv(f, index=False, sep=',', encoding='utf-8')
-                # indicate file is saved in folder list 
-                if self.folder_dir:
-                    self.which_are_done(f.name)
+        if self.recording is not None:
+            f = filedialog.asksaveasfilename(defaultextension=".csv",
+                initialfile=os.path.splitext(self.recording.filename)[0] + '.csv',
+                filetypes=[('CSV files', '*.csv'),
+                           ('Compressed CSV files', '*.csv.gz'),
+                           ('Parquet files', '*.parquet')])
+            if f:
+                self.status.set('Saving ' + os.path.split(f)[1])
+                self.parent.update_idletasks()
+                try:
+                    sleep_spans, discard_spans = self.labels.spans()
+                    write_labeled(self.recording, sleep_spans, discard_spans, f)
+                except (OSError, ValueError) as error:
+                    messagebox.showerror('Acti :: Label Tool', 'Cannot save file:\n%s' % error)
+                    return
+                finally:
+                    self.status.set('')
+                self.record_done(f)
         else:
             pass
 
+    def btn_compare(self):
+        """ open several recordings stacked in the compare window """
+        paths = filedialog.askopenfilenames(initialdir=self.folder_dir or None,
+            filetypes=[('ActiGraph files', '*.csv *.agd'), ('CSV files', '*.csv',),
+                       ('AGD files', '*.agd',)])
+        if paths:
+            if self.compare is not None:
+                self.compare.close()
+            self.compare = compare_window(self, list(paths))
+
     def btn_about(self):
         """author contact information window"""
         ttk.simpleDialog.showinfo('About Acti :: Label Tool', 
@@ -151,29 +2044,54 @@ class label_tool:
         #help_dialog = simpledialog.Dialog(self.parent, "About Acti::Label Tool")
         #ttk.Label(help_dialog, text='ok').grid(column=0, row=0)
 
+    def btn_latency(self):
+        """ toggle the frame time overlay """
+        self.view.show_latency(self.show_latency.get())
+
+    def btn_trace(self):
+        """ save the stage timings of this session """
+        f = filedialog.asksaveasfilename(defaultextension='.json',
+            initialfile='label_tool_trace.json', filetypes=[('JSON files', '*.json')])
+        if f:
+            try:
+                timings.dump(f)
+            except OSError as error:
+                messagebox.showerror('Acti :: Label Tool', 'Cannot save trace:\n%s' % error)
+
     def btn_exit(self):
         """quit program"""
+        for future in self.prefetched.values():
+            future.cancel()
+        self.loader.shutdown(wait=False)
+        self.opener.shutdown(wait=False)
+        self.folder_reader.shutdown(wait=False)
+        if self.compare is not None:
+            self.compare.close()
+        if self.journal is not None:
+            self.journal_writer.submit(self.journal.close)
+        self.journal_writer.shutdown(wait=True)
         self.parent.destroy()
 
     def btn_undo(self):
         """Undo labeling, all kinds of them"""
-        self.current_xlim = self.fig_plot_vm.get_xlim()
-        if self.labels is None:
-            pass
-        elif self.labels.shape[0] == 1:
-            # erase dataframe marker, set self.labels to None
-            self.dataframe.loc[self.dataframe.ts_num == self.labels['where'].iloc[0] , "marker"] = 0
-            self.labels = None
-            self.plot()
-        else:
-            self.dataframe.loc[self.dataframe.ts_num == self.labels['where'].iloc[-1] , "marker"] = 0
-            self.labels.drop(self.labels.tail(1).index,inplace=True)
-            self.plot()
+        if self.labels is not None and self.labels.undo():
+            self.labels_changed()
+
+    def btn_redo(self):
+        """Redo the last undone labeling"""
+        if self.labels is not None and self.labels.redo():
+            self.labels_changed()
 
     def button_press_func(self, event):
         """
         Define mouse click behavior
         """
+        # left click in the overview jumps there, dragging keeps jumping
+        if event.inaxes is self.fig_plot_overview:
+            if event.button == 1:
+                self.overview_drag = True
+                self.jump_to(event.xdata)
+            return
         # left click and hold to pan plot
         if event.button == 1:
             self.button_1_pressed = True
@@ -189,12 +2107,16 @@ class label_tool:
         """Release mouse left click is end of drag pan"""
         if event.button == 1:
             self.button_1_pressed = False
+            self.overview_drag = False
             self.mouse_event = None
             self.pan_init_xlim = None
 
     def motion_notify_func(self, event):
         """When left clicked, drag motion triggers panning"""
-        if self.button_1_pressed is True:
+        if self.overview_drag:
+            if event.inaxes is self.fig_plot_overview:
+                self.jump_to(event.xdata, coalesce=True)
+        elif self.button_1_pressed is True:
             if event.x != self.mouse_event.x:
                 current_xlim = self.fig_plot_vm.get_xlim()
                 start_data = self.fig_plot_vm.transData.inverted().transform_point((self.mouse_event.x, self.mouse_event.y))
@@ -202,42 +2124,45 @@ class label_tool:
                 move_delta = (end_data[0] - start_data[0])
                 self.fig_plot_vm.set_xlim([self.pan_init_xlim[0] - move_delta,
                     self.pan_init_xlim[1] - move_delta])
-                self.plot_canvas.draw()
+                self.view.move_cursor(event, blit=False)
+                self.refresh_later()
+        else:
+            self.view.move_cursor(event)
 
     def key_press_func(self, event):
         """Use keyboard to zoom or pan"""
-        if self.dataframe is not None:
+        if self.recording is not None:
             current_xlim = self.fig_plot_vm.get_xlim()
             current_xrange = (current_xlim[1] - current_xlim[0])
             scale_factor = 0.1
             if event.key == 'left':
                 self.fig_plot_vm.set_xlim([current_xlim[0] - current_xrange/30,
                     current_xlim[1] - current_xrange/30])
-                self.plot_canvas.draw()
+                self.refresh_view()
             elif event.key == 'right':
                 self.fig_plot_vm.set_xlim([current_xlim[0] + current_xrange/30,
                     current_xlim[1] + current_xrange/30])
-                self.plot_canvas.draw()
+                self.refresh_view()
             elif event.key == 'up':
                 # zoom in
                 self.fig_plot_vm.set_xlim([current_xlim[0] + scale_factor*current_xrange,
                     current_xlim[1] - scale_factor*current_xrange])
-                self.fig_plot_vm.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M:%S'))
-                self.fig.autofmt_xdate()
-                self.plot_canvas.draw()
+                self.refresh_view()
             elif event.key == 'down':
                 # zoom out
                 self.fig_plot_vm.set_xlim([current_xlim[0] - scale_factor*current_xrange,
                     current_xlim[1] + scale_factor*current_xrange])
-                self.fig_plot_vm.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M:%S'))
-                self.fig.autofmt_xdate()
-                self.plot_canvas.draw()
+                self.refresh_view()
+            elif event.key == 'ctrl+z':
+                self.btn_undo()
+            elif event.key == 'ctrl+y':
+                self.btn_redo()
             else:
                 pass
 
     def scroll_func(self, event):
         """use mouse scroll to zoom"""
-        if self.dataframe is not None:
+        if self.recording is not None:
             current_xlim = self.fig_plot_vm.get_xlim()
             current_xrange = (current_xlim[1] - current_xlim[0])
             scale_factor = self.zoom_speed
@@ -246,19 +2171,27 @@ class label_tool:
                 # zoom in
                 self.fig_plot_vm.set_xlim([current_xlim[0] + scale_factor*current_xrange, 
                     current_xlim[1] - scale_factor*current_xrange])
-                self.fig_plot_vm.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M:%S'))
-                self.fig.autofmt_xdate()
-                self.plot_canvas.draw()
+                self.refresh_view()
             elif event.button == 'down':
                 # zoom out
                 self.fig_plot_vm.set_xlim([current_xlim[0] - scale_factor*current_xrange, 
                     current_xlim[1] + scale_factor*current_xrange])
-                self.fig_plot_vm.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M:%S'))
-                self.fig.autofmt_xdate()
-                self.plot_canvas.draw()
+                self.refresh_view()
             else:
                 pass
 
+    def jump_to(self, x, coalesce=False):
+        """ center the plot on x, keeping the zoom """
+        if self.recording is None or x is None:
+            return
+        x0, x1 = self.fig_plot_vm.get_xlim()
+        half = (x1 - x0) / 2
+        self.fig_plot_vm.set_xlim(x - half, x + half)
+        if coalesce:
+            self.refresh_later()
+        else:
+            self.refresh_view()
+
     def label_popup_menu(self):
         """ create a pop-up menu at the clicked point on the plot """
         popup = Menu(self.parent)
@@ -268,6 +2201,9 @@ class label_tool:
         popup.add_command(label="Discard data before this point", command=self.label_discard_before)
         popup.add_command(label="Discard data after this point", command=self.label_discard_after)
         popup.add_separator()
+        popup.add_command(label="Remove nearest label", command=self.label_remove)
+        popup.add_command(label="Accept suggestion here", command=self.label_accept)
+        popup.add_separator()
         popup.add_command(label="Cancel")
         popup.tk_popup(int(self.parent.winfo_pointerx()), int(self.parent.winfo_pointery()))
         popup.grab_release()
@@ -284,79 +2220,207 @@ class label_tool:
     def label_discard_before(self):
         self.which_x('db')
 
-    def which_x(self, label):
-        # TODO: add a check when event.xdata is out of dataframe bounds
-        target_x = self.mouse_event.xdata
-        # finding neighbor x
-        if self.dataframe.loc[self.dataframe.ts_num == target_x].shape[0] == 1:
-            target_x = target_x
-        else:
-            up_x = self.dataframe.loc[self.dataframe.ts_num < target_x].iloc[-1,].ts_num
-            down_x = self.dataframe.loc[self.dataframe.ts_num > target_x].iloc[0,].ts_num
-            if (target_x - up_x) > (down_x - target_x):
-                target_x = down_x
+    def label_remove(self):
+        if self.labels is not None and self.mouse_event.xdata is not None:
+            if self.labels.remove_nearest(self.mouse_event.xdata) is not None:
+                self.labels_changed()
+
+    def label_accept(self):
+        if self.suggestions is not None and self.mouse_event.xdata is not None:
+            self.accept_suggestions(self.mouse_event.xdata)
+
+    def suggest(self, blit=True):
+        """ score the current file for sleep and non-wear candidates """
+        if self.recording is None:
+            return
+        try:
+            self.suggestions = suggest_spans(self.recording, self.sleep_scorer.get(),
+                                             self.nonwear_scorer.get())
+        except (KeyError, ValueError) as error:
+            self.suggestions = None
+            if isinstance(error, KeyError):
+                self.status.set('No suggestions, missing column %s' % error)
             else:
-                target_x = up_x
-        # mark in label container
-        if self.labels is None:
-            self.labels = pd.DataFrame({'where':[target_x], 'state':[label]})
+                self.status.set('No suggestions, %s' % error)
+            self.view.set_suggestions([], [])
         else:
-            self.labels = self.labels.append({'where':target_x, 'state':label}, ignore_index=True)
-        self.plot()
+            self.show_suggestions()
+        if blit:
+            self.view.blit()
+
+    def show_suggestions(self):
+        """ put the suggested periods on the suggestion band """
+        last = len(self.ts_num) - 1
+        self.view.set_suggestions(*(self.ts_num[np.minimum(spans, last)]
+                                    for spans in self.suggestions))
+
+    def accept_suggestions(self, x=None):
+        """ turn the suggestions into labels, only the one around x if given """
+        if self.suggestions is None:
+            return
+        sleep_spans, nonwear_spans = self.suggestions
+        if x is not None:
+            # the suggested periods containing the clicked row
+            row = nearest_index(self.ts_num, x)
+            sleep_spans = sleep_spans[(sleep_spans[:, 0] <= row) & (row < sleep_spans[:, 1])]
+            nonwear_spans = nonwear_spans[(nonwear_spans[:, 0] <= row) & (row < nonwear_spans[:, 1])]
+        rows, states = suggested_labels(len(self.ts_num), sleep_spans, nonwear_spans)
+        # one edit, so a single undo takes all of them back
+        labels = [(self.ts_num[row], state) for row, state in zip(rows, states)
+                  if not self.labels.has(self.ts_num[row], state)]
+        if labels:
+            self.labels.add_all(labels)
+            self.labels_changed()
+
+    def which_x(self, label):
+        if self.ts_num is None or self.mouse_event.xdata is None:
+            return
+        # snap to the nearest sample, clicks outside the data go to its ends
+        target_x = self.ts_num[nearest_index(self.ts_num, self.mouse_event.xdata)]
+        # mark in label container
+        self.labels.add(target_x, label)
+        self.labels_changed()
+
+    def labels_changed(self):
+        """ show a label edit and have it journaled shortly after """
+        self.plot_labels()
+        self.plot_overview_labels()
+        self.view.blit()
+        if self.journal is not None and self.journal_flush is None:
+            self.journal_flush = self.parent.after(JOURNAL_FLUSH_MS, self.flush_journal)
+
+    def flush_journal(self):
+        """ write the journaled edits on the writer thread """
+        self.journal_flush = None
+        if self.journal is not None:
+            if self.journal.error is not None:
+                self.status.set('Label journal off: %s' % self.journal.error)
+            self.journal_writer.submit(self.journal.flush)
 
     def reset(self):
         """ reset variables before loading new file """
         self.mouse_event = None
         self.current_xlim = None
-        if self.labels is not None:
-            self.labels = None
-
-    def read_file(self, file_name=None, file_path=None):
-        """ Utility function for loading data """
-        if file_path is None:
-            file_path = self.folder_dir + "/" + file_name
-        self.dataframe = pd.read_csv(file_path,
-                delimiter=',', encoding="utf-8-sig")
-        self.dataframe.filename = os.path.split(file_path)[1]
-        self.file_menu.entryconfig('Save', state='normal')
+        self.labels = None
+        self.suggestions = None
+        if self.journal is not None:
+            # the next file may be this one again, whose journal is read
+            # right away, so wait for the last edits to be written
+            self.journal_writer.submit(self.journal.close).result()
+            self.journal = None
 
-    def format_data(self):
+    def open_file(self, file_path):
         """
-        Prepare data; called by other methods
+        Load a file in the background and show it once it is ready, so the
+        window stays responsive during the parse
         """
-        self.dataframe.reset_index()
-        self.dataframe.columns = self.dataframe.columns.str.lower()
-        col_names = self.dataframe.columns.values
-        # get a timestamp column
-        if 'date' in col_names:
-            self.dataframe['timestamp'] = pd.to_datetime(self.dataframe['date'] + ' ' + self.dataframe['time'])
-        elif 'ts' in col_names:
-            self.dataframe['timestamp'] = pd.to_datetime(self.dataframe['ts'])
-        elif 'timestamp' in col_names:
-            self.dataframe['timestamp'] = pd.to_datetime(self.dataframe['timestamp'])
-        self.dataframe['ts_num'] = date2num(self.dataframe['timestamp'])  # matplotlib data2num
-        if 'vector.magnitude' in col_names:
-            self.dataframe.rename(columns={'vector.magnitude': 'vm'}, inplace=True)
-
-    def tidy(self):
-        """ tidy data before saving """
-        # process sleep marker
-        self.dataframe['sleep'] = self.dataframe.shape[0]*[0]
-        sleep_labels = self.labels[self.labels['state'].isin(['s', 'e'])]
-        for i in range(0, sleep_labels.shape[0]):
-            if sleep_labels['state'].iloc[i] == 's':
-                self.dataframe.loc[self.dataframe.ts_num >= sleep_labels['where'].iloc[i], 'sleep'] = 1
-            elif sleep_labels['state'].iloc[i] == 'e':
-                self.dataframe.loc[self.dataframe.ts_num >= sleep_labels['where'].iloc[i], 'sleep'] = 0
-        # process discard marker
-        self.dataframe['discard'] = self.dataframe.shape[0]*[0]
-        discard_labels = self.labels[self.labels['state'].isin(['db', 'da'])]
-        for i in range(0, discard_labels.shape[0]):
-            if discard_labels['state'].iloc[i] == 'db':
-                self.dataframe.loc[self.dataframe.ts_num < discard_labels['where'].iloc[i], 'discard'] = 1
-            elif discard_labels['state'].iloc[i] == 'da':
-                self.dataframe.loc[self.dataframe.ts_num > discard_labels['where'].iloc[i], 'discard'] = 1
-        self.dataframe = self.dataframe[['timestamp', 'axis1', 'axis2', 'axis3', 'vm', 'sleep', 'discard']]  # put it in the end
+        future = self.prefetched.pop(file_path, None)
+        # a prefetch still queued behind the others would wait for them
+        if future is None or future.cancel():
+            future = self.opener.submit(load_recording, file_path, self.cache)
+        if self.pending_load is not None:
+            self.pending_load.cancel()  # superseded, unless already loading
+        self.pending_load = future
+        self.status.set('Loading ' + os.path.split(file_path)[1])
+        self.progress.start(10)
+        if self.load_poll is None:
+            self.poll_load()
+
+    def poll_load(self):
+        """ hand the pending load to the Tk thread once it is finished """
+        self.load_poll = None
+        future = self.pending_load
+        if future is None:
+            return
+        if not future.done():
+            self.load_poll = self.parent.after(50, self.poll_load)
+            return
+        self.pending_load = None
+        self.progress.stop()
+        self.status.set('')
+        try:
+            rec = future.result()
+        except Exception as error:
+            messagebox.showerror('Acti :: Label Tool', 'Cannot load file:\n%s' % error)
+            return
+        self.reset()
+        self.show_recording(rec)
+        self.plot()
+        self.prefetch_next()
+
+    def prefetch_next(self):
+        """ load the next files of the folder list that are not done yet """
+        if not self.folder_dir:
+            return
+        names = list(self.file_list.get(0, END))
+        start = 0
+        if self.recording is not None and self.recording.filename in names:
+            start = names.index(self.recording.filename) + 1
+        wanted = [os.path.join(self.folder_dir, name) for name in names[start:]
+                  if name not in self.done_files][:PREFETCH_FILES]
+        # results nobody is going to ask for only hold memory
+        for file_path in list(self.prefetched):
+            if file_path not in wanted:
+                self.prefetched.pop(file_path).cancel()
+        for file_path in wanted:
+            if file_path not in self.prefetched:
+                self.prefetched[file_path] = self.loader.submit(
+                    load_recording, file_path, self.cache)
+        if self.prefetch_poll is None:
+            self.poll_prefetch()
+
+    def poll_prefetch(self):
+        """ report background loads in the status bar until they finish """
+        self.prefetch_poll = None
+        if self.pending_load is not None:
+            # the status bar is showing the foreground load
+            self.prefetch_poll = self.parent.after(200, self.poll_prefetch)
+            return
+        running = sum(not future.done() for future in self.prefetched.values())
+        if running:
+            self.status.set('Preparing next %d file(s)' % running)
+            self.progress.start(10)
+            self.prefetch_poll = self.parent.after(200, self.poll_prefetch)
+        else:
+            self.status.set('')
+            self.progress.stop()
+
+    def show_recording(self, rec):
+        """ make a loaded recording the one being labeled """
+        self.recording = rec
+        self.ts_num = rec.ts_num
+        self.pyramid = rec.pyramid
+        self.labels = label_store(rec.ts_num)
+        if rec.file_path is not None:
+            # pick up the labels of an earlier session on this file
+            journal_path = rec.file_path + JOURNAL_SUFFIX
+            self.labels.replay(label_journal.read(journal_path), self.labels.snap)
+            if len(self.labels):
+                self.status.set('Restored %d labels' % len(self.labels))
+            self.journal = label_journal(journal_path)
+            self.labels.journal = self.journal
+            sidecar = rec.file_path + LABEL_SIDECAR
+            if not len(self.labels) and os.path.exists(sidecar):
+                # a first session on labels written outside the window
+                try:
+                    for timestamp, state in zip(*read_label_sidecar(sidecar)):
+                        self.labels.add(self.labels.snap(timestamp), state)
+                except (OSError, ValueError, KeyError) as error:
+                    messagebox.showwarning('Acti :: Label Tool',
+                                           'Cannot read %s:\n%s' % (sidecar, error))
+                else:
+                    self.status.set('Loaded %d labels' % len(self.labels))
+            suggested = rec.file_path + SUGGEST_SIDECAR
+            if os.path.exists(suggested):
+                # written by the suggest command, shown until accepted
+                try:
+                    timestamps, states = read_label_sidecar(suggested)
+                    rows = np.searchsorted(rec.ts_num, snap_labels(rec.ts_num, timestamps))
+                    self.suggestions = suggestion_spans(rows, states)
+                except (OSError, ValueError, KeyError) as error:
+                    messagebox.showwarning('Acti :: Label Tool',
+                                           'Cannot read %s:\n%s' % (suggested, error))
+        self.file_menu.entryconfig('Save', state='normal')
 
     def read_selected_file(self, event):
         """
@@ -365,102 +2429,530 @@ class label_tool:
         """
         selected_file = self.file_list.get(ACTIVE)
         if selected_file:
-            self.reset()
-            self.read_file(selected_file)
-            self.format_data()
-            self.plot()
+            self.open_file(os.path.join(self.folder_dir, selected_file))
 
     def which_are_done(self, result_dir=None):
-        """ determine which files are done by comparing file and result folders """
+        """ determine which files are done from the result folder manifest """
         if result_dir is not None:
             self.folder_labeled_dir = os.path.split(result_dir)[0]
-        list_of_files = sorted(os.listdir(self.folder_dir))
-        list_of_labeled_files = sorted(os.listdir(self.folder_labeled_dir))
-        for n in range(0, len(list_of_labeled_files)):
-            nn = list_of_files.index(list_of_labeled_files[n])
-            self.file_list.itemconfig(nn, bg='grey', fg='white')
+        if self.progress_index is None or self.progress_index.folder != self.folder_labeled_dir:
+            self.progress_index = progress_index(self.folder_labeled_dir)
+        for n, name in enumerate(self.file_list.get(0, END)):
+            if name not in self.done_files and self.progress_index.is_done(name):
+                self.file_list.itemconfig(n, bg='grey', fg='white')
+                self.done_files.add(name)
+        if self.progress_poll is None:
+            self.progress_poll = self.parent.after(PROGRESS_REFRESH_MS, self.poll_progress)
+
+    def poll_progress(self):
+        """ pick up outputs and manifest entries of other labelers or the batch export """
+        self.progress_poll = None
+        if self.progress_index is None or not self.folder_dir:
+            self.progress_refresh = None
+            return
+        if self.progress_refresh is None:
+            self.progress_refresh = self.folder_reader.submit(self.progress_index.refresh)
+        elif self.progress_refresh.done():
+            refresh, self.progress_refresh = self.progress_refresh, None
+            if refresh.exception() is None and refresh.result():
+                self.which_are_done()
+        wait = 200 if self.progress_refresh is not None else PROGRESS_REFRESH_MS
+        self.progress_poll = self.parent.after(wait, self.poll_progress)
+
+    def record_done(self, output_path):
+        """ note a saved file in the result folder manifest and the folder list """
+        folder = os.path.split(output_path)[0]
+        if self.progress_index is None or self.progress_index.folder != folder:
+            self.progress_index = progress_index(folder)
+        file_hash = None
+        if self.recording.file_path is not None:
+            file_hash = content_digest(self.recording.file_path)
+        n_labels = len(self.labels)
+        try:
+            self.progress_index.record(self.recording.filename, output_path,
+                                       file_hash, n_labels)
+        except OSError as error:
+            messagebox.showwarning('Acti :: Label Tool',
+                                   'Cannot update %s:\n%s' % (PROGRESS_MANIFEST, error))
+        # indicate file is saved in folder list
+        if self.folder_dir:
+            self.which_are_done(output_path)
 
     def plot(self):
         """plot utility"""
-        self.fig_plot_vm.clear()
-        self.fig_plot_label.clear()
-        self.fig_plot_vm.plot(self.dataframe['timestamp'], self.dataframe['vm'], 
-                                alpha=0.5, marker='o', markersize=5)
-        self.fig_plot_vm.fill_between(date2num(self.dataframe['timestamp']), 0, self.dataframe['vm'],
-                                        alpha = 0.3)
-        self.fig_plot_vm.set_ylim(min(self.dataframe['vm']), max([3000]))
-        # plot label
-        if self.labels is not None:
-            loc_in_dataframe = self.dataframe['ts_num'].isin(list(self.labels['where']))
-            label_x = list(self.dataframe.loc[loc_in_dataframe, "timestamp"])
-            label_y = self.labels.shape[0]*[0]
-            self.fig_plot_label.plot(label_x, label_y, 'ro')  # rewrite this to make it shorter
-            # shade labeled sleep area and discarded area
-            if self.labels.shape[0] >= 2:
-                for i in range(0, self.labels.shape[0]-1):
-                    if self.labels['state'].iloc[i] == 's' and self.labels['state'].iloc[i+1] == 'e':
-                        start = self.labels['where'].iloc[i]
-                        end = self.labels['where'].iloc[i+1]
-                        xtime = date2num(self.dataframe['timestamp'])
-                        xtime = xtime[xtime >= start]
-                        xtime = xtime[xtime <= end]
-                        self.fig_plot_label.fill_between(xtime, 0, 3000,
-                                                        color='grey',
-                                                        alpha = 0.4)
-                for i in range(0, self.labels.shape[0]):
-                    if self.labels['state'].iloc[i] == 'db':
-                        start = date2num(min(self.dataframe['timestamp']))
-                        end = self.labels['where'].iloc[i]
-                        xtime = date2num(self.dataframe['timestamp'])
-                        xtime = xtime[xtime >= start]
-                        xtime = xtime[xtime <= end]
-                        self.fig_plot_label.fill_between(xtime, 0, 3000,
-                                                        color='black',
-                                                        alpha = 0.8)
-                    elif self.labels['state'].iloc[i] == 'da':
-                        start = self.labels['where'].iloc[i]
-                        end = date2num(max(self.dataframe['timestamp']))
-                        xtime = date2num(self.dataframe['timestamp'])
-                        xtime = xtime[xtime >= start]
-                        xtime = xtime[xtime <= end]
-                        self.fig_plot_label.fill_between(xtime, 0, 3000,
-                                                        color='black',
-                                                        alpha = 0.8)
-            elif self.labels.shape[0] == 1:
-                if self.labels['state'].iloc[0] == 'db':
-                    start = date2num(min(self.dataframe['timestamp']))
-                    end = self.labels['where'].iloc[0]
-                    xtime = date2num(self.dataframe['timestamp'])
-                    xtime = xtime[xtime >= start]
-                    xtime = xtime[xtime <= end]
-                    self.fig_plot_label.fill_between(xtime, 0, 3000,
-                                                    color='black',
-                                                    alpha = 0.8)
-            self.fig_plot_label.set_ylim(min(self.dataframe['vm']), max([3000]))
-            self.fig_plot_label.yaxis.set_ticks([])
-
+        ts_num = self.ts_num
         if self.current_xlim is None:
-            self.fig_plot_vm.set_xlim(min(self.dataframe['timestamp']), max(self.dataframe['timestamp']))
+            xlim = [ts_num[0], ts_num[-1]]
         else:
-            self.fig_plot_vm.set_xlim([self.current_xlim[0], self.current_xlim[1]])
-        self.fig_plot_vm.set_title(os.path.split(self.dataframe.filename)[1])
-        self.fig_plot_vm.set_xlabel('Timestamp')
-        self.fig_plot_vm.set_ylabel('Counts')
-        self.fig_plot_vm.xaxis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M:%S'))
-        self.fig.autofmt_xdate()
-        self.fig_plot_vm.axhline(y=100, color='r', linestyle='--', alpha=0.5, linewidth=1)  #TODO: modifiable
-        self.fig_plot_vm.axhline(y=500, color='r', linestyle='--', alpha=0.5, linewidth=1)  #TODO: modifiable
-        self.fig_plot_vm.grid(True)
-        self.cursor = Cursor(self.fig_plot_label,
-                        horizOn = True,
-                        vertOn = True,
-                        color = 'green',
-                        linewidth=0.3)
-        self.plot_canvas.draw()
+            xlim = [self.current_xlim[0], self.current_xlim[1]]
+        self.view.set_data(self.pyramid,
+                           self.recording.filename,
+                           xlim, self.pyramid.levels[-1][1].min())
+        self.plot_labels()
+        self.plot_overview_labels()
+        if self.suggestions is None:
+            self.suggest(blit=False)
+        else:
+            self.show_suggestions()
+        with timings.timed('full redraw'):
+            self.plot_canvas.draw()
+
+    def plot_labels(self):
+        """ update label markers and shading of the visible labeled periods """
+        if self.labels is None:
+            return
+        x0, x1 = self.fig_plot_vm.get_xlim()
+        marks, sleep_x, discard_x = self.labels.visible(x0, x1)
+        self.view.set_labels(marks, sleep_x, discard_x)
+
+    def plot_overview_labels(self):
+        """ update the label shading of the overview """
+        sleep_x, discard_x = self.labels.compile()[2:]
+        self.view.set_overview_labels(sleep_x, discard_x)
+
+    def refresh_view(self):
+        """ redraw after the visible x range changed """
+        self.plot_labels()
+        self.view.refresh()
+
+    def refresh_later(self):
+        """
+        redraw once Tk is idle; a drag moves the x range on every motion
+        event but only the latest range is drawn
+        """
+        if self.refresh_pending is None:
+            self.refresh_pending = self.parent.after_idle(self.refresh_idle)
+
+    def refresh_idle(self):
+        self.refresh_pending = None
+        if self.recording is not None:
+            self.refresh_view()
+
+
+class compare_track:
+    """ One recording of the compare window, its data only while loaded """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.name = os.path.split(file_path)[1]
+        self.rec = None  # recording, memory mapped from the cache if possible
+        self.sleep_x = None  # x ranges of the labeled sleep periods
+        self.discard_x = None  # x ranges of the discarded periods
+        self.offset = 0.0  # days the track is shifted left on the shared axis
+        self.future = None  # pending load_track
+        self.error = None  # why the track could not be loaded
+
+    def unload(self):
+        self.rec = self.sleep_x = self.discard_x = None
+
+
+def load_track(file_path, cache=None):
+    """
+    A recording for the compare window and the x ranges of its sleep and
+    discard labels, taken from its journal or else its label sidecar. With
+    a cache the recording is memory mapped, so only the decimation levels
+    on screen are ever read.
+    """
+    rec = load_recording(file_path, cache, out_of_core=cache is not None)
+    labels = label_store(rec.ts_num)
+    if os.path.exists(file_path + JOURNAL_SUFFIX):
+        labels.replay(label_journal.read(file_path + JOURNAL_SUFFIX), labels.snap)
+    elif os.path.exists(file_path + LABEL_SIDECAR):
+        for timestamp, state in zip(*read_label_sidecar(file_path + LABEL_SIDECAR)):
+            labels.add(labels.snap(timestamp), state)
+    sleep_x, discard_x = labels.compile()[2:]
+    return rec, sleep_x, discard_x
+
+
+class compare_window:
+    """
+    Window with the tracks of several recordings stacked on one x axis.
+    Tracks are loaded in the background once they scroll into view, and
+    the data of the least recently shown ones is dropped again beyond
+    COMPARE_KEEP loaded tracks. With "Align days" on, every track is
+    shifted so its first day lines up with the first track loaded.
+    """
+    def __init__(self, tool, file_paths):
+        self.tool = tool
+        self.tracks = [compare_track(file_path) for file_path in file_paths]
+        self.rows = min(COMPARE_ROWS, len(self.tracks))
+        self.first = 0  # index of the track in the top row
+        self.loaded = collections.OrderedDict()  # file path -> track, least recently shown first
+        self.reference = None  # first day (x units) of the first track loaded
+        self.pan = None  # (pixel x, xlim, axes) of a drag in progress
+        self.refresh_pending = None  # after_idle() id of a coalesced redraw
+        self.poll = None  # after() id while tracks are loading
+        # its own threads, so tracks neither wait for the prefetches of the
+        # main window nor hold up the files opened there
+        self.loader = ThreadPoolExecutor(max_workers=PREFETCH_FILES)
+        self.top = Toplevel(tool.parent)
+        self.top.title('Acti :: Compare')
+        self.top.grid_rowconfigure(1, weight=1)
+        self.top.grid_columnconfigure(0, weight=1)
+        self.top.protocol('WM_DELETE_WINDOW', self.close)
+        self.align = BooleanVar(value=True)
+        self.status = StringVar()
+        bar = ttk.Frame(self.top)
+        bar.grid(column=0, row=0, sticky=(W, E))
+        ttk.Checkbutton(bar, text='Align days', variable=self.align,
+                        command=self.realign).grid(column=0, row=0, padx=5)
+        ttk.Label(bar, textvariable=self.status).grid(column=1, row=0, padx=5)
+        frame = ttk.Frame(self.top)
+        frame.grid(column=0, row=1, sticky=(N, W, E, S))
+        self.fig = Figure()
+        self.canvas = FigureCanvasTkAgg(self.fig, master=frame)
+        self.canvas._tkcanvas.pack(fill=BOTH, expand=True)
+        self.scrollbar = ttk.Scrollbar(self.top, orient=VERTICAL,
+                                       command=self.scroll_rows)
+        self.scrollbar.grid(column=1, row=1, sticky=(N, S))
+        self.view = compare_view(self.fig, self.canvas, self.rows)
+        self.canvas.mpl_connect('scroll_event', self.scroll_func)
+        self.canvas.mpl_connect('key_press_event', self.key_press_func)
+        self.canvas.mpl_connect('button_press_event', self.button_press_func)
+        self.canvas.mpl_connect('button_release_event', self.button_release_func)
+        self.canvas.mpl_connect('motion_notify_event', self.motion_notify_func)
+        self.show_page()
+
+    def show_page(self):
+        """ show the tracks from self.first on, loading the ones not loaded """
+        visible = self.tracks[self.first:self.first + self.rows]
+        for row, track in enumerate(visible):
+            if track.rec is not None:
+                self.loaded.move_to_end(track.file_path)
+            elif track.future is None and track.error is None:
+                track.future = self.loader.submit(load_track, track.file_path,
+                                                  self.tool.cache)
+            self.view.show(row, track)
+        # loads of tracks scrolled away before they started
+        for track in self.tracks:
+            if track.future is not None and track not in visible and track.future.cancel():
+                track.future = None
+        self.scrollbar.set(self.first / len(self.tracks),
+                           (self.first + self.rows) / len(self.tracks))
+        if self.poll is None:
+            self.poll_tracks()
+        self.canvas.draw_idle()
+
+    def poll_tracks(self):
+        """ show tracks as their loads finish """
+        self.poll = None
+        pending = 0
+        changed = False
+        for track in self.tracks:
+            if track.future is None:
+                continue
+            if not track.future.done():
+                pending += 1
+                continue
+            future, track.future = track.future, None
+            try:
+                track.rec, track.sleep_x, track.discard_x = future.result()
+            except Exception as error:
+                track.error = str(error)
+            else:
+                self.loaded[track.file_path] = track
+                self.place(track)
+            if track in self.view.tracks:
+                self.view.show(self.view.tracks.index(track), track)
+                changed = True
+        self.evict()
+        self.status.set('Loading %d file(s)' % pending if pending else '')
+        if changed:
+            self.canvas.draw_idle()
+        if pending:
+            self.poll = self.top.after(50, self.poll_tracks)
+
+    def place(self, track):
+        """ shift a track so its first day lines up with the reference """
+        day = math.floor(track.rec.ts_num[0])
+        if self.reference is None:
+            # the first track loaded sets the day grid and the initial range
+            self.reference = day
+            self.view.axes[0].set_xlim(track.rec.ts_num[0], track.rec.ts_num[-1])
+            self.format_axis()
+        track.offset = day - self.reference if self.align.get() else 0.0
+
+    def evict(self):
+        """ drop the data of the least recently shown tracks, never a visible one """
+        for file_path in list(self.loaded):
+            if len(self.loaded) <= COMPARE_KEEP:
+                break
+            if self.loaded[file_path] not in self.view.tracks:
+                self.loaded.pop(file_path).unload()
+
+    def realign(self):
+        """ apply a change of the Align days setting """
+        for track in self.loaded.values():
+            self.place(track)
+        self.format_axis()
+        for row, track in enumerate(self.view.tracks):
+            self.view.show(row, track)
+        self.canvas.draw_idle()
+
+    def format_axis(self):
+        """ aligned tracks are labeled in days of the recording, others by date """
+        axis = self.view.axes[0].xaxis
+        if self.align.get() and self.reference is not None:
+            reference = self.reference
+            axis.set_major_formatter(FuncFormatter(lambda x, pos: 'day %d %s' % (
+                math.floor(x - reference) + 1, num2date(x).strftime('%H:%M'))))
+        else:
+            axis.set_major_formatter(matplotlib.dates.DateFormatter('%Y-%m-%d %H:%M'))
+
+    def refresh(self):
+        """ redraw after the visible x range changed """
+        self.view.update_data()
+        self.canvas.draw_idle()
+
+    def refresh_idle(self):
+        self.refresh_pending = None
+        self.refresh()
+
+    def set_xlim(self, x0, x1):
+        self.view.axes[0].set_xlim(x0, x1)
+        self.refresh()
+
+    def scroll_rows(self, *args):
+        """ scrollbar command: moveto fraction, or scroll n units/pages """
+        if args[0] == 'moveto':
+            first = int(round(float(args[1]) * len(self.tracks)))
+        else:
+            first = self.first + int(args[1]) * (self.rows if args[2] == 'pages' else 1)
+        first = max(0, min(first, len(self.tracks) - self.rows))
+        if first != self.first:
+            self.first = first
+            self.show_page()
+
+    def button_press_func(self, event):
+        """ drag to pan, double click a track to open it for labeling """
+        if event.inaxes not in self.view.axes:
+            return
+        if event.dblclick:
+            track = self.view.tracks[self.view.axes.index(event.inaxes)]
+            if track is not None:
+                self.tool.open_file(track.file_path)
+                self.tool.parent.lift()
+        elif event.button == 1:
+            self.pan = (event.x, event.inaxes.get_xlim(), event.inaxes)
+
+    def button_release_func(self, event):
+        if event.button == 1:
+            self.pan = None
+
+    def motion_notify_func(self, event):
+        if self.pan is None:
+            return
+        x, (x0, x1), ax = self.pan
+        delta = (event.x - x) * (x1 - x0) / ax.bbox.width
+        self.view.axes[0].set_xlim(x0 - delta, x1 - delta)
+        # one redraw for all the motion events queued meanwhile
+        if self.refresh_pending is None:
+            self.refresh_pending = self.top.after_idle(self.refresh_idle)
+
+    def key_press_func(self, event):
+        """ arrows pan and zoom like the main plot, page up/down scroll tracks """
+        x0, x1 = self.view.axes[0].get_xlim()
+        step = (x1 - x0) / 30
+        zoom = 0.1 * (x1 - x0)
+        if event.key == 'left':
+            self.set_xlim(x0 - step, x1 - step)
+        elif event.key == 'right':
+            self.set_xlim(x0 + step, x1 + step)
+        elif event.key == 'up':
+            self.set_xlim(x0 + zoom, x1 - zoom)
+        elif event.key == 'down':
+            self.set_xlim(x0 - zoom, x1 + zoom)
+        elif event.key == 'pageup':
+            self.scroll_rows('scroll', -1, 'pages')
+        elif event.key == 'pagedown':
+            self.scroll_rows('scroll', 1, 'pages')
+
+    def scroll_func(self, event):
+        """ use mouse scroll to zoom """
+        x0, x1 = self.view.axes[0].get_xlim()
+        zoom = self.tool.zoom_speed * (x1 - x0)
+        if event.button == 'up':
+            self.set_xlim(x0 + zoom, x1 - zoom)
+        elif event.button == 'down':
+            self.set_xlim(x0 - zoom, x1 + zoom)
+
+    def close(self):
+        """ cancel pending loads and let go of every track """
+        if self.poll is not None:
+            self.top.after_cancel(self.poll)
+        if self.refresh_pending is not None:
+            self.top.after_cancel(self.refresh_pending)
+        for track in self.tracks:
+            if track.future is not None:
+                track.future.cancel()
+            track.unload()
+        self.loader.shutdown(wait=False)
+        self.loaded.clear()
+        self.top.destroy()
+        if self.tool.compare is self:
+            self.tool.compare = None
+
+
+def export_one(task):
+    """ batch worker: load, label and write one recording """
+    file_path, (timestamps, states), output_path, use_cache = task
+    name = os.path.split(file_path)[1]
+    try:
+        rec = load_recording(file_path, recording_cache() if use_cache else None)
+        # tables and sidecars need not be in time order; a stable sort keeps
+        # the listed order of labels at the same sample
+        where = snap_labels(rec.ts_num, timestamps)
+        order = np.argsort(where, kind='stable')
+        sleep_spans, discard_spans = compile_labels(
+            rec.ts_num, where[order], np.asarray(states)[order])
+        write_labeled(rec, sleep_spans, discard_spans, output_path)
+    except Exception as error:
+        return name, 'fail', str(error)
+    return name, 'done', '%d rows' % len(rec.ts_num)
+
+
+def batch_export(input_dir, output_dir, label_table=None, jobs=None,
+                 use_cache=False, output_format='csv'):
+    """
+    Label and export every recording of a folder on a process pool. Labels
+    come from a single table or from the journal or label sidecar next to
+    each file; each worker writes its output as soon as it is done, and
+    the manifest of the output folder is updated as each file finishes.
+    Returns the number of failed files.
+    """
+    table = read_label_table(label_table) if label_table else None
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = []
+    for name in list_recordings(input_dir):
+        file_path = os.path.join(input_dir, name)
+        if table is not None:
+            labels = table.get(name)
+        elif os.path.exists(file_path + JOURNAL_SUFFIX):
+            # the journal includes any sidecar labels loaded in the window
+            labels = journal_labels(file_path + JOURNAL_SUFFIX)
+        elif os.path.exists(file_path + LABEL_SIDECAR):
+            labels = read_label_sidecar(file_path + LABEL_SIDECAR)
+        else:
+            labels = None
+        if labels is None:
+            print('skip  %s  no labels' % name)
+            continue
+        output_path = os.path.join(output_dir, os.path.splitext(name)[0] +
+                                   EXPORT_FORMATS[output_format])
+        tasks.append((file_path, labels, output_path, use_cache))
+    # the workers only write outputs, the manifest is kept by this process
+    # alone so no two writers race on it
+    index = progress_index(output_dir)
+    by_name = {os.path.split(task[0])[1]: task for task in tasks}
+    failed = 0
+    with multiprocessing.Pool(jobs, maxtasksperchild=50) as pool:
+        for name, status, detail in pool.imap_unordered(export_one, tasks):
+            print('%-5s %s  %s' % (status, name, detail), flush=True)
+            failed += status == 'fail'
+            if status == 'done':
+                file_path, (timestamps, states), output_path, _ = by_name[name]
+                try:
+                    index.record(name, output_path, content_digest(file_path),
+                                 len(states))
+                except OSError as error:
+                    print('warn  %s  cannot update %s: %s'
+                          % (name, PROGRESS_MANIFEST, error), flush=True)
+    return failed
+
+
+def suggest_one(task):
+    """ batch worker: score one recording and write its suggestions sidecar """
+    file_path, sleep, nonwear, use_cache = task
+    name = os.path.split(file_path)[1]
+    try:
+        rec = load_recording(file_path, recording_cache() if use_cache else None)
+        if rec.raw:
+            return name, 'skip', 'raw samples, the scorers need epoch counts'
+        rows, states = suggestion_rows(*suggest_spans(rec, sleep, nonwear))
+        timestamps = pd.to_datetime(rec.column('timestamp')[rows])
+        write_label_sidecar(file_path + SUGGEST_SIDECAR, timestamps, states)
+    except Exception as error:
+        return name, 'fail', str(error)
+    return name, 'done', '%d suggested periods' % (len(states) // 2)
+
+
+def batch_suggest(input_dir, sleep='cole-kripke', nonwear='choi', jobs=None,
+                  use_cache=False, overwrite=False):
+    """
+    Write suggested labels of every recording of a folder to its
+    suggestions sidecar, where the window shows them to be accepted or
+    not; the export never reads them. Recordings that already have
+    suggestions, labels or a journal are left alone unless overwrite is
+    set. Returns the number of failed files.
+    """
+    tasks = []
+    for name in list_recordings(input_dir):
+        file_path = os.path.join(input_dir, name)
+        if not overwrite and (os.path.exists(file_path + SUGGEST_SIDECAR) or
+                              os.path.exists(file_path + LABEL_SIDECAR) or
+                              os.path.exists(file_path + JOURNAL_SUFFIX)):
+            print('skip  %s  already suggested or labeled' % name)
+            continue
+        tasks.append((file_path, sleep, nonwear, use_cache))
+    failed = 0
+    with multiprocessing.Pool(jobs, maxtasksperchild=50) as pool:
+        for name, status, detail in pool.imap_unordered(suggest_one, tasks):
+            print('%-5s %s  %s' % (status, name, detail), flush=True)
+            failed += status == 'fail'
+    return failed
+
 
+def main(argv=None):
+    """ start the labeling window, or run a batch command when given one """
+    parser = argparse.ArgumentParser(prog='label_tool.py',
+                                     description='Acti :: Label Tool')
+    parser.add_argument('--trace', metavar='JSON',
+        help='write the stage timings of this run to a json trace on exit')
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export',
+        help='apply labels to a folder of recordings and write the results')
+    export.add_argument('input_dir', help='folder of csv/agd recordings')
+    export.add_argument('output_dir', help='folder for the labeled files')
+    export.add_argument('--labels', metavar='CSV',
+        help='one label table with file, timestamp and state columns; by '
+             'default each recording uses its <file>%s sidecar, or the '
+             '<file>%s journal left by the window' % (LABEL_SIDECAR, JOURNAL_SUFFIX))
+    export.add_argument('--jobs', type=int, default=None,
+        help='worker processes (default: all cores)')
+    export.add_argument('--format', choices=sorted(EXPORT_FORMATS),
+        default='csv', help='output file format (default: csv)')
+    export.add_argument('--cache', action='store_true',
+        help='read and fill the recording cache')
+    suggest = commands.add_parser('suggest',
+        help='score a folder of recordings and write suggestions to review in the window')
+    suggest.add_argument('input_dir', help='folder of csv/agd recordings')
+    suggest.add_argument('--sleep', choices=sorted(SLEEP_SCORERS),
+        default='cole-kripke', help='sleep algorithm (default: cole-kripke)')
+    suggest.add_argument('--nonwear', choices=sorted(NONWEAR_SCORERS),
+        default='choi', help='non-wear algorithm (default: choi)')
+    suggest.add_argument('--jobs', type=int, default=None,
+        help='worker processes (default: all cores)')
+    suggest.add_argument('--cache', action='store_true',
+        help='read and fill the recording cache')
+    suggest.add_argument('--overwrite', action='store_true',
+        help='also score recordings that already have suggestions or labels')
+    args = parser.parse_args(argv)
+    if args.command == 'export':
+        status = 1 if batch_export(args.input_dir, args.output_dir, args.labels,
+                                   args.jobs, args.cache, args.format) else 0
+    elif args.command == 'suggest':
+        status = 1 if batch_suggest(args.input_dir, args.sleep, args.nonwear,
+                                    args.jobs, args.cache, args.overwrite) else 0
+    else:
+        root = Tk()
+        tool = label_tool(root)
+        # closing the window writes the journal like File > Exit
+        root.protocol('WM_DELETE_WINDOW', tool.btn_exit)
+        root.mainloop()
+        status = 0
+    if args.trace:
+        timings.dump(args.trace)
+    return status
 
 
 if __name__ == "__main__":
-    root = Tk()
-    tool = label_tool(root)
-    root.mainloop()
+    sys.exit(main())